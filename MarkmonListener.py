@@ -14,6 +14,11 @@ class MarkmonListener(sublime_plugin.EventListener):
         self.settings = None
         self.on_setting_change_callbacks = []
         self.on_modified_callbacks = []
+        self.on_text_changed_callbacks = []
+        self.on_text_reset_callbacks = []
+        self.on_close_callbacks = []
+        self.on_saved_callbacks = []
+        self.on_selection_modified_callbacks = []
 
         self.__class__.shared_instance = self
 
@@ -25,6 +30,21 @@ class MarkmonListener(sublime_plugin.EventListener):
     def add_on_modified(self, callback):
         self.on_modified_callbacks.append(callback)
 
+    def add_on_text_changed(self, callback):
+        self.on_text_changed_callbacks.append(callback)
+
+    def add_on_text_reset(self, callback):
+        self.on_text_reset_callbacks.append(callback)
+
+    def add_on_close(self, callback):
+        self.on_close_callbacks.append(callback)
+
+    def add_on_saved(self, callback):
+        self.on_saved_callbacks.append(callback)
+
+    def add_on_selection_modified(self, callback):
+        self.on_selection_modified_callbacks.append(callback)
+
     def load_settings(self):
         self.settings = sublime.load_settings('sublime-text-markmon.sublime-settings')
         self.settings.add_on_change("*", self.settings_updated)
@@ -40,3 +60,45 @@ class MarkmonListener(sublime_plugin.EventListener):
     def on_activated_async(self, view):
         for callback in self.on_modified_callbacks:
             callback(view)
+
+    def on_close(self, view):
+        for callback in self.on_close_callbacks:
+            callback(view)
+
+    def on_post_save_async(self, view):
+        for callback in self.on_saved_callbacks:
+            callback(view)
+
+    def on_selection_modified_async(self, view):
+        for callback in self.on_selection_modified_callbacks:
+            callback(view)
+
+    def text_changed(self, buffer, changes):
+        for callback in self.on_text_changed_callbacks:
+            callback(buffer.primary_view(), changes)
+
+    def text_reset(self, buffer):
+        for callback in self.on_text_reset_callbacks:
+            callback(buffer.id(), buffer.primary_view().change_count())
+
+
+# TextChangeListener is only available from Sublime Text 4
+if hasattr(sublime_plugin, 'TextChangeListener'):
+    class MarkmonTextChangeListener(sublime_plugin.TextChangeListener):
+        # on_text_changed runs on the main thread right after the change,
+        # so the change count read alongside it matches the changes.
+
+        @classmethod
+        def is_applicable(cls, buffer):
+            # the base class applies to no buffer; which views are previewed
+            # is decided per view, so record the changes of every buffer
+            return True
+
+        def on_text_changed(self, changes):
+            MarkmonListener.shared_plugin().text_changed(self.buffer, changes)
+
+        def on_revert(self):
+            MarkmonListener.shared_plugin().text_reset(self.buffer)
+
+        def on_reload(self):
+            MarkmonListener.shared_plugin().text_reset(self.buffer)
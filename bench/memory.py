@@ -0,0 +1,67 @@
+# coding=utf8
+
+"""
+Memory benchmark of a full preview update of a large document.
+
+A document of --size characters (50M by default) is sent once as a single
+payload and once streamed in chunks, to the stand-in server of run.py. The
+allocation peak of each update is measured with tracemalloc; the document
+itself is allocated before tracing starts and is not counted.
+
+    python3 bench/memory.py --size 50M
+
+"""
+
+import argparse
+import os
+import threading
+import time
+import tracemalloc
+
+from run import BENCH_DIR, SETTINGS, StandInServer, load_plugin, make_document, parse_size
+
+
+def measure(client, view):
+    """Send view once and return (seconds, peak allocation in bytes)."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    client.send_full(view)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the memory of a full markmon update.')
+    parser.add_argument('--size', default='50M', help='document size')
+    args = parser.parse_args()
+
+    markmon, listener_module = load_plugin()
+
+    import sublime
+    server = StandInServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sublime.settings_files[SETTINGS] = sublime.Settings({'port': server.server_port})
+
+    listener_module.MarkmonListener()
+    plugin = markmon.get_markmon()
+    size = parse_size(args.size)
+    view = sublime.View(make_document(size), file_name=os.path.join(BENCH_DIR, 'bench.md'))
+    sublime.window.focus_view(view)
+
+    print('{:>10} {:>10} {:>10} {:>14} {:>10}'.format('size', 'mode', 'seconds', 'peak alloc', 'x size'))
+    for mode, threshold in (('payload', 0), ('streamed', 1)):
+        plugin.settings.settings['stream_threshold'] = threshold
+        plugin.client.reset_document()
+        server.reset()
+        elapsed, peak = measure(plugin.client, view)
+        assert server.bytes >= size, 'the server received {} bytes'.format(server.bytes)
+        print('{:>10} {:>10} {:>10.2f} {:>14} {:>10.2f}'.format(size, mode, elapsed, peak, peak / size))
+
+    plugin.client.sender.stop()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+# coding=utf8
+
+"""
+Headless benchmark of the keystroke-to-preview path.
+
+The plugin is loaded with the stand-in sublime modules from this directory
+and talks to a local stand-in server. Synthetic typing is driven through
+MarkmonListener, so every edit goes through the same scheduler, sender and
+MarkmonClient code as in the editor. For each document size the benchmark
+reports throughput, keystroke-to-server latency, time spent in the editor
+callback, bytes sent and the allocation peak.
+
+    python3 bench/run.py --sizes 1K,1M --output after.json --compare before.json
+
+With --check the exit status is 1 when the plugin import is over its
+budget or a metric regressed by more than --threshold against --compare.
+
+"""
+
+import argparse
+import http.server
+import importlib
+import json
+import os
+import platform
+import random
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+PACKAGE = 'markmon_bench'
+SETTINGS = 'sublime-text-markmon.sublime-settings'
+
+# metrics compared by --compare, all of them lower is better
+COMPARED = ('latency_p50_ms', 'latency_p99_ms', 'callback_p99_us', 'bytes_sent', 'peak_alloc_bytes')
+
+
+def load_plugin():
+    """Import the plugin package against the stand-in sublime modules."""
+    sys.path.insert(0, BENCH_DIR)
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [ROOT]
+    sys.modules[PACKAGE] = package
+    markmon = importlib.import_module(PACKAGE + '.markmon')
+    listener = importlib.import_module(PACKAGE + '.MarkmonListener')
+    return markmon, listener
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            size = 0
+            while True:
+                length = int(self.rfile.readline().split(b';')[0], 16)
+                size += len(self.rfile.read(length))
+                self.rfile.readline()
+                if not length:
+                    return size, b''
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        return len(body), body
+
+    def respond(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        size, _ = self.read_body()
+        self.server.record(self.headers.get('X-Markmon-Revision'), size)
+        self.respond(200)
+
+    def do_PATCH(self):
+        size, body = self.read_body()
+        if not self.server.accept_deltas:
+            self.respond(405)
+            return
+        self.server.record(json.loads(body.decode('utf-8')).get('revision'), size)
+        self.respond(204)
+
+    def do_POST(self):
+        size, _ = self.read_body()
+        self.server.record(None, size)
+        self.respond(204)
+
+    def do_DELETE(self):
+        self.read_body()
+        self.respond(200)
+
+
+class StandInServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Accept preview updates and record when each revision arrived."""
+
+    daemon_threads = True
+
+    def __init__(self, accept_deltas=False):
+        super().__init__(('localhost', 0), StandInHandler)
+        self.accept_deltas = accept_deltas
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        with self.condition:
+            self.received = []
+            self.bytes = 0
+            self.latest = -1
+
+    def record(self, revision, size):
+        now = time.perf_counter()
+        with self.condition:
+            self.bytes += size
+            if revision is not None:
+                revision = int(revision)
+                self.received.append((revision, now))
+                self.latest = max(self.latest, revision)
+            self.condition.notify_all()
+
+    def wait_for(self, revision, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.latest < revision:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+
+def parse_size(text):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def make_document(size, seed=0):
+    """Return a Markdown document of roughly size characters."""
+    rng = random.Random(seed)
+    words = ('markmon', 'preview', 'latency', 'render', 'pandoc', 'buffer', 'block',
+             'server', 'update', 'document', 'heading', 'paragraph', '$x^2$', '`code`')
+    parts = []
+    total = 0
+    section = 0
+    while total < size:
+        if total == 0 or rng.random() < 0.1:
+            section += 1
+            part = '## Section {}\n\n'.format(section)
+        else:
+            part = ' '.join(rng.choice(words) for _ in range(rng.randint(20, 80))) + '\n\n'
+        parts.append(part)
+        total += len(part)
+    return ''.join(parts)[:size]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def attach_text_listener(listener, view):
+    """Attach the plugin's TextChangeListener to the view's buffer if it applies, as Sublime Text does."""
+    cls = sys.modules[type(listener).__module__].MarkmonTextChangeListener
+    if cls.is_applicable(view.buffer()):
+        text_listener = cls()
+        text_listener.buffer = view.buffer()
+        view.text_listeners.append(lambda buffer, changes: text_listener.on_text_changed(changes))
+
+
+def run_case(listener, server, size, args):
+    import sublime
+
+    view = sublime.View(make_document(size), file_name=os.path.join(BENCH_DIR, 'bench.md'))
+    attach_text_listener(listener, view)
+    sublime.window.focus_view(view)
+    server.reset()
+
+    rng = random.Random(size)
+    point = len(view.text) // 2
+    typed_at = {}
+    callback_times = []
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    for key in range(args.keys):
+        view.insert(point, '\n' if key % 40 == 39 else rng.choice('abcdefgh '))
+        point += 1
+        before = time.perf_counter()
+        typed_at[view.change_count()] = before
+        listener.on_modified_async(view)
+        callback_times.append(time.perf_counter() - before)
+        time.sleep(args.interval / 1000.0)
+    complete = server.wait_for(view.change_count(), args.timeout)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = [arrived - typed_at[revision] for revision, arrived in server.received if revision in typed_at]
+    return {
+        'size': size,
+        'keys': args.keys,
+        'complete': complete,
+        'updates': len(latencies),
+        'seconds': elapsed,
+        'keys_per_second': args.keys / elapsed,
+        'updates_per_second': len(latencies) / elapsed,
+        'megabytes_per_second': server.bytes / elapsed / (1 << 20),
+        'latency_p50_ms': ms(percentile(latencies, 0.5)),
+        'latency_p99_ms': ms(percentile(latencies, 0.99)),
+        'callback_p50_us': us(percentile(callback_times, 0.5)),
+        'callback_p99_us': us(percentile(callback_times, 0.99)),
+        'bytes_sent': server.bytes,
+        'peak_alloc_bytes': peak
+    }
+
+
+def ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def us(seconds):
+    return None if seconds is None else seconds * 1000000
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Print the change of each metric against baseline and return the regressions."""
+    regressions = []
+    old_cases = {case['size']: case for case in baseline.get('cases', [])}
+    for case in results['cases']:
+        old = old_cases.get(case['size'])
+        if not old:
+            continue
+        for metric in COMPARED:
+            if not old.get(metric) or case.get(metric) is None:
+                continue
+            ratio = case[metric] / old[metric]
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = '  REGRESSION'
+                regressions.append((case['size'], metric, ratio))
+            print('{:>10} {:<18} {:>12.1f} -> {:>12.1f} ({:+.0%}){}'.format(
+                case['size'], metric, old[metric], case[metric], ratio - 1, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the markmon keystroke-to-preview path.')
+    parser.add_argument('--sizes', default='1K,10K,100K,1M,10M', help='comma separated document sizes')
+    parser.add_argument('--keys', type=int, default=100, help='keystrokes per document size')
+    parser.add_argument('--interval', type=float, default=5, help='milliseconds between keystrokes')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for the last update')
+    parser.add_argument('--debounce', type=int, default=0, help='"debounce" setting in milliseconds')
+    parser.add_argument('--max-latency', type=int, default=1000, help='"max_latency" setting in milliseconds')
+    parser.add_argument('--delta', action='store_true', help='enable "delta_updates"')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 on regressions or import over budget')
+    args = parser.parse_args()
+
+    markmon, listener_module = load_plugin()
+
+    import sublime
+    server = StandInServer(accept_deltas=args.delta)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    settings = {
+        'port': server.server_port,
+        'debounce': args.debounce,
+        'max_latency': args.max_latency,
+        'delta_updates': args.delta
+    }
+    sublime.settings_files[SETTINGS] = sublime.Settings(settings)
+
+    listener = listener_module.MarkmonListener()
+    plugin = markmon.get_markmon()
+    plugin.settings.running = True
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'settings': settings,
+        'import_time_ms': markmon.IMPORT_TIME * 1000,
+        'import_time_budget_ms': markmon.IMPORT_TIME_BUDGET * 1000,
+        'cases': []
+    }
+    print('plugin import: {:.1f}ms (budget {:.0f}ms)'.format(
+        results['import_time_ms'], results['import_time_budget_ms']))
+    print('{:>10} {:>8} {:>10} {:>10} {:>12} {:>12} {:>12} {:>12}'.format(
+        'size', 'updates', 'p50 ms', 'p99 ms', 'cb p99 us', 'MB/s', 'bytes', 'peak alloc'))
+
+    for size in [parse_size(size) for size in args.sizes.split(',')]:
+        case = run_case(listener, server, size, args)
+        results['cases'].append(case)
+        print('{size:>10} {updates:>8} {latency_p50_ms:>10.2f} {latency_p99_ms:>10.2f} '
+              '{callback_p99_us:>12.1f} {megabytes_per_second:>12.2f} {bytes_sent:>12} '
+              '{peak_alloc_bytes:>12}'.format(**case))
+
+    plugin.client.sender.stop()
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = markmon.IMPORT_TIME > markmon.IMPORT_TIME_BUDGET
+    if args.compare:
+        with open(args.compare) as f:
+            failed = bool(compare(results, json.load(f), args.threshold)) or failed
+
+    if args.check and failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
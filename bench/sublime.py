@@ -0,0 +1,244 @@
+# coding=utf8
+
+"""
+A stand-in for the sublime module so the plugin can run headless.
+
+Only the parts of the API the plugin uses are provided. Views hold their
+text in memory and timeouts run on threading.Timer threads.
+
+"""
+
+import os
+import re
+import tempfile
+import threading
+
+
+class Region:
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def __repr__(self):
+        return 'Region({}, {})'.format(self.a, self.b)
+
+
+class Settings:
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self.callbacks = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+        for callback in list(self.callbacks.values()):
+            callback()
+
+    def has(self, key):
+        return key in self.values
+
+    def add_on_change(self, tag, callback):
+        self.callbacks[tag] = callback
+
+    def clear_on_change(self, tag):
+        self.callbacks.pop(tag, None)
+
+
+settings_files = {}
+
+
+def load_settings(name):
+    return settings_files.setdefault(name, Settings())
+
+
+def set_timeout(callback, delay=0):
+    timer = threading.Timer(delay / 1000.0, callback)
+    timer.daemon = True
+    timer.start()
+
+
+set_timeout_async = set_timeout
+
+
+def platform():
+    return {'nt': 'windows', 'posix': 'linux'}.get(os.name, 'linux')
+
+
+def cache_path():
+    return os.path.join(tempfile.gettempdir(), 'markmon-bench-cache')
+
+
+def executable_path():
+    return ''
+
+
+def error_message(message):
+    print('error:', message)
+
+
+def status_message(message):
+    pass
+
+
+class HistoricPosition:
+    def __init__(self, pt):
+        self.pt = pt
+
+
+class TextChange:
+    def __init__(self, a, b, text):
+        self.a = HistoricPosition(a)
+        self.b = HistoricPosition(b)
+        self.str = text
+
+
+class Buffer:
+    def __init__(self, view):
+        self.view = view
+
+    def id(self):
+        return self.view.buffer_id()
+
+    def primary_view(self):
+        return self.view
+
+
+class View:
+    next_id = 1
+
+    def __init__(self, text='', file_name=None, scope='text.html.markdown'):
+        self.view_id = View.next_id
+        View.next_id += 1
+        self.text = text
+        self.path = file_name
+        self.scope = scope
+        self.changes = 0
+        self.view_settings = Settings({'syntax': 'Packages/Markdown/Markdown.sublime-syntax'})
+        self.status = {}
+        self.selection = [Region(0)]
+        self.viewport = Region(0, min(len(text), 4000))
+        self.text_listeners = []
+
+    def id(self):
+        return self.view_id
+
+    def buffer_id(self):
+        return self.view_id
+
+    def buffer(self):
+        return Buffer(self)
+
+    def is_valid(self):
+        return True
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        if isinstance(region, int):
+            return self.text[region:region + 1]
+        return self.text[region.begin():region.end()]
+
+    def scope_name(self, point):
+        return self.scope
+
+    def file_name(self):
+        return self.path
+
+    def name(self):
+        return ''
+
+    def change_count(self):
+        return self.changes
+
+    def settings(self):
+        return self.view_settings
+
+    def set_status(self, key, value):
+        self.status[key] = value
+
+    def erase_status(self, key):
+        self.status.pop(key, None)
+
+    def sel(self):
+        return self.selection
+
+    def visible_region(self):
+        return self.viewport
+
+    def rowcol(self, point):
+        row = self.text.count('\n', 0, point)
+        return row, point - (self.text.rfind('\n', 0, point) + 1)
+
+    def text_point(self, row, col):
+        point = 0
+        for _ in range(row):
+            point = self.text.find('\n', point)
+            if point < 0:
+                return len(self.text)
+            point += 1
+        return point + col
+
+    def line(self, point):
+        begin = self.text.rfind('\n', 0, point) + 1
+        end = self.text.find('\n', point)
+        return Region(begin, len(self.text) if end < 0 else end)
+
+    def find_all(self, pattern, flags=0, fmt=None, extractions=None):
+        regions = []
+        template = re.sub(r'\$(\d+)', r'\\g<\1>', fmt) if fmt is not None else None
+        for match in re.finditer(pattern, self.text, re.MULTILINE):
+            regions.append(Region(match.start(), match.end()))
+            if template is not None and extractions is not None:
+                extractions.append(match.expand(template))
+        return regions
+
+    def replace(self, region, text):
+        """Replace region with text the way an edit in the editor would."""
+        begin, end = region.begin(), region.end()
+        self.text = self.text[:begin] + text + self.text[end:]
+        self.changes += 1
+        for listener in self.text_listeners:
+            listener(self.buffer(), [TextChange(begin, end, text)])
+
+    def insert(self, point, text):
+        self.replace(Region(point), text)
+
+
+class Window:
+    def __init__(self):
+        self.views_list = []
+        self.active = None
+
+    def active_view(self):
+        return self.active
+
+    def views(self):
+        return list(self.views_list)
+
+    def focus_view(self, view):
+        if view not in self.views_list:
+            self.views_list.append(view)
+        self.active = view
+
+
+window = Window()
+
+
+def active_window():
+    return window
+
+
+def windows():
+    return [window]
@@ -0,0 +1,32 @@
+# coding=utf8
+
+"""A stand-in for the sublime_plugin module so the plugin can run headless."""
+
+
+class EventListener:
+    pass
+
+
+class ViewEventListener:
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand:
+    def __init__(self, window):
+        self.window = window
+
+
+class TextCommand:
+    def __init__(self, view):
+        self.view = view
+
+
+class TextChangeListener:
+    def __init__(self):
+        self.buffer = None
+
+    @classmethod
+    def is_applicable(cls, buffer):
+        # as in Sublime Text: subclasses must opt in
+        return False
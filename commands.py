@@ -1,14 +1,5 @@
-import sublime
-import time
 import sublime_plugin
-import webbrowser
-import subprocess
-import atexit
-import re
-from .MarkmonListener import MarkmonListener
-import http.client
-from . import util, markmon
-import os
+from . import markmon
 
 class MarkmonToggleCommand(sublime_plugin.WindowCommand):
     def __init__(self, window):
@@ -18,9 +9,19 @@ class MarkmonToggleCommand(sublime_plugin.WindowCommand):
 
     def run(self, **args):
         if args['enable']:
-            markmon.markmon.set_running(True)
-        else:
+            markmon.get_markmon().set_running(True)
+        elif markmon.markmon:
             markmon.markmon.set_running(False)
 
     def is_enabled(self):
-        return True
\ No newline at end of file
+        return True
+
+
+class MarkmonStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        panel = self.window.create_output_panel('markmon_stats')
+        panel.run_command('append', {'characters': markmon.get_markmon().stats_report()})
+        self.window.run_command('show_panel', {'panel': 'output.markmon_stats'})
+
+    def is_enabled(self):
+        return markmon.markmon is not None
@@ -0,0 +1,111 @@
+# coding=utf8
+
+"""Let the preview follow the caret and viewport."""
+
+import json
+import threading
+import time
+
+import sublime
+
+from .transport import MarkmonSender
+
+
+class MarkmonCursorSync:
+    """
+    Tell the server where the caret and viewport of a view are.
+
+    Positions go out as small POST /cursor messages on their own sender
+    thread, apart from document updates; the server only scrolls the
+    preview and never renders for them. A view sends at most one message
+    per "scroll_sync_interval" milliseconds: moves in between are coalesced
+    into the latest position, and a position equal to the last one sent is
+    not sent again. A server that does not accept the messages is not sent
+    any more until reset() is called.
+
+    channel, when given, returns the channel of the client or None; positions
+    then go over the channel, unacknowledged, instead of as requests.
+
+    """
+
+    def __init__(self, settings, connections, channel=None):
+        self.settings = settings
+        self.connections = connections
+        self.channel = channel
+        self.sender = MarkmonSender("markmon-cursor")
+        self.lock = threading.Lock()
+        # view id -> view whose position is sent once its interval passed
+        self.pending = {}
+        # view id -> (time, position) of the last message
+        self.last = {}
+        self.supported = True
+
+    def reset(self):
+        with self.lock:
+            self.last.clear()
+        self.supported = True
+
+    def selection_modified(self, view):
+        if not (self.supported and self.settings.settings["scroll_sync"]):
+            return
+        view_id = view.id()
+        interval = self.settings.settings["scroll_sync_interval"] / 1000.0
+        with self.lock:
+            if view_id in self.pending:
+                self.pending[view_id] = view
+                return
+            self.pending[view_id] = view
+            last = self.last.get(view_id)
+            wait = 0 if last is None else interval - (time.monotonic() - last[0])
+        if wait > 0:
+            sublime.set_timeout_async(lambda: self.flush(view_id), int(wait * 1000) + 1)
+        else:
+            self.flush(view_id)
+
+    def flush(self, view_id):
+        with self.lock:
+            view = self.pending.pop(view_id, None)
+        if view is None or not view.is_valid():
+            return
+        position = self.position(view)
+        with self.lock:
+            last = self.last.get(view_id)
+            self.last[view_id] = (time.monotonic(), position)
+        if last is None or last[1] != position:
+            self.sender.submit(view_id, lambda: self.send(position))
+
+    def position(self, view):
+        visible = view.visible_region()
+        selection = view.sel()
+        cursor = selection[0].b if len(selection) else visible.begin()
+        return {
+            "buffer": view.buffer_id(),
+            "line": view.rowcol(cursor)[0],
+            "top": view.rowcol(visible.begin())[0],
+            "bottom": view.rowcol(visible.end())[0],
+            "lines": view.rowcol(view.size())[0] + 1,
+            "point": visible.begin()
+        }
+
+    def send(self, position):
+        try:
+            channel = self.channel() if self.channel else None
+            if channel:
+                channel.send({"type": "cursor", "position": position})
+                return
+            status, _ = self.connections.request(self.settings.client_url, 'POST', '/cursor',
+                                                 json.dumps(position).encode('utf-8'),
+                                                 {"Content-Type": "application/json"})
+        except OSError:
+            # a server that is down is restarted by the next document update
+            return
+        if status not in (200, 204):
+            self.supported = False
+
+    def forget(self, view_id):
+        with self.lock:
+            self.pending.pop(view_id, None)
+            self.last.pop(view_id, None)
+
+    def stop(self):
+        self.sender.stop()
@@ -0,0 +1,91 @@
+# coding=utf8
+
+"""Bookkeeping for incremental (delta) updates to the markmon server."""
+
+import threading
+
+
+class MarkmonChangeTracker:
+    """
+    Record text changes per buffer so updates can be sent as deltas.
+
+    Changes are stored together with the buffer change count that they lead
+    to. A delta can be built from any base revision at or above the buffer's
+    floor, which is the first revision from which every later change has been
+    recorded. When too much text is pending, or the buffer is reverted or
+    reloaded (which does not produce text changes), the recorded changes are
+    dropped and the next update falls back to sending the full document.
+
+    """
+
+    MAX_PENDING = 1 << 20
+
+    def __init__(self):
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def record(self, buffer_id, revision, changes):
+        with self.lock:
+            entry = self.buffers.get(buffer_id)
+            if entry is None:
+                self.buffers[buffer_id] = {
+                    "floor": revision, "reset_at": None, "latest": revision, "changes": [], "size": 0}
+                return
+            entry["latest"] = revision
+            if entry["floor"] is None:
+                # nothing can be built on these changes until the next full update
+                return
+            for change in changes:
+                entry["changes"].append((revision, change.a.pt, change.b.pt, change.str))
+                entry["size"] += len(change.str)
+            if entry["size"] > self.MAX_PENDING:
+                self._reset(entry, revision)
+
+    def reset(self, buffer_id, revision):
+        with self.lock:
+            entry = self.buffers.get(buffer_id)
+            if entry is not None:
+                self._reset(entry, revision)
+
+    def _reset(self, entry, revision):
+        entry["floor"] = None
+        entry["reset_at"] = revision
+        entry["latest"] = revision
+        entry["changes"] = []
+        entry["size"] = 0
+
+    def delta(self, buffer_id, base):
+        """
+        Return a (revision, changes) tuple bringing the buffer from base up to date.
+
+        changes is a list of [begin, end, text] replacements to apply in order.
+        None is returned when the changes since base are not all known.
+
+        """
+        with self.lock:
+            entry = self.buffers.get(buffer_id)
+            if entry is None or entry["floor"] is None or base < entry["floor"]:
+                return None
+            changes = [[a, b, text] for rev, a, b, text in entry["changes"] if rev > base]
+            revision = max([base] + [rev for rev, _, _, _ in entry["changes"]])
+            return revision, changes
+
+    def rebase(self, buffer_id, revision):
+        """Forget the changes already applied by the server at revision."""
+        with self.lock:
+            entry = self.buffers.get(buffer_id)
+            if entry is None:
+                return
+            if entry["floor"] is None:
+                if revision < entry["reset_at"]:
+                    return
+                # changes made since revision were not kept, so deltas
+                # can only start from the latest one
+                entry["floor"] = max(revision, entry["latest"])
+            entry["floor"] = max(entry["floor"], revision)
+            entry["changes"] = [c for c in entry["changes"] if c[0] > revision]
+            entry["size"] = sum(len(c[3]) for c in entry["changes"])
+
+    def discard(self, buffer_id):
+        with self.lock:
+            self.buffers.pop(buffer_id, None)
@@ -0,0 +1,66 @@
+# coding=utf8
+
+"""Which views markmon previews."""
+
+import os
+
+
+class MarkmonEligibility:
+    """
+    Remember per view whether markmon previews it.
+
+    A view is eligible when its syntax file or base scope contains one of
+    the "syntaxes" (case-insensitive), or its file name ends with one of the
+    "extensions". The answer is cached by view id together with the syntax
+    it was computed for, so a lookup is a single dict access. A watcher on
+    the view settings drops the entry when the syntax changes; forget()
+    drops it when the view is saved under another name or closed.
+
+    """
+
+    WATCH_KEY = 'markmon-eligibility'
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.views = {}
+        self.watched = {}
+
+    def eligible(self, view):
+        entry = self.views.get(view.id())
+        if entry is None:
+            entry = self.views[view.id()] = self.check(view)
+            self.watch(view)
+        return entry[1]
+
+    def check(self, view):
+        syntax = view.settings().get('syntax') or ''
+        names = (syntax + ' ' + view.scope_name(0)).lower()
+        if any(name.lower() in names for name in self.settings.settings["syntaxes"]):
+            return syntax, True
+        extensions = self.settings.settings["extensions"]
+        if extensions and view.file_name():
+            extension = os.path.splitext(view.file_name())[1].lower()
+            return syntax, extension in [ext.lower() for ext in extensions]
+        return syntax, False
+
+    def watch(self, view):
+        view_id = view.id()
+        if view_id in self.watched:
+            return
+        settings = self.watched[view_id] = view.settings()
+        settings.add_on_change(self.WATCH_KEY, lambda: self.settings_changed(view_id, settings))
+
+    def settings_changed(self, view_id, settings):
+        entry = self.views.get(view_id)
+        if entry and settings.get('syntax') != entry[0]:
+            self.views.pop(view_id, None)
+
+    def forget(self, view, closed=False):
+        self.views.pop(view.id(), None)
+        if closed:
+            settings = self.watched.pop(view.id(), None)
+            if settings:
+                settings.clear_on_change(self.WATCH_KEY)
+
+    def clear(self):
+        self.views.clear()
@@ -0,0 +1,104 @@
+# coding=utf8
+
+"""Windowed previews of documents too large to send whole."""
+
+import threading
+import time
+
+import sublime
+
+HEADING_PATTERN = r'^#{1,6}[ \t]+[^\n]*'
+
+
+class MarkmonLargeFile:
+    """
+    Read windows of large documents and their heading outline.
+
+    A document over "large_file_threshold" characters is previewed a window
+    at a time: the blocks around the given points, about "large_file_window"
+    characters to each side. Windows start and end on blank lines so
+    paragraphs are not cut in half; a boundary is looked for within SNAP
+    characters and falls back to a line break.
+
+    The outline lists the ATX headings of the whole document as
+    (point, level, title) tuples. It is found by the editor in one call and
+    reused for OUTLINE_INTERVAL seconds, so the points may lag behind the
+    latest edits; it is only used to navigate.
+
+    """
+
+    SNAP = 8192
+    OUTLINE_INTERVAL = 2.0
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.outlines = {}
+        self.lock = threading.Lock()
+
+    def applies(self, view):
+        threshold = self.settings.settings["large_file_threshold"]
+        return bool(threshold) and view.size() > threshold
+
+    def around(self, view, points):
+        """Return (begin, end, text) of the window around points."""
+        radius = self.settings.settings["large_file_window"]
+        return self.read(view, self.snap_back(view, min(points) - radius),
+                         self.snap_forward(view, max(points) + radius))
+
+    def before(self, view, point):
+        """Return the window that ends at point, which is a window boundary."""
+        radius = self.settings.settings["large_file_window"]
+        return self.read(view, self.snap_back(view, point - 2 * radius), point)
+
+    def after(self, view, point):
+        """Return the window that starts at point, which is a window boundary."""
+        radius = self.settings.settings["large_file_window"]
+        return self.read(view, point, self.snap_forward(view, point + 2 * radius))
+
+    def read(self, view, begin, end):
+        return begin, end, view.substr(sublime.Region(begin, end))
+
+    def snap_back(self, view, point):
+        if point <= 0:
+            return 0
+        start = max(0, point - self.SNAP)
+        text = view.substr(sublime.Region(start, point))
+        index = text.rfind('\n\n')
+        if index >= 0:
+            return start + index + 2
+        if start == 0:
+            return 0
+        return start + text.rfind('\n') + 1
+
+    def snap_forward(self, view, point):
+        size = view.size()
+        if point >= size:
+            return size
+        text = view.substr(sublime.Region(point, min(size, point + self.SNAP)))
+        index = text.find('\n\n')
+        if index < 0:
+            index = text.find('\n')
+            if index < 0:
+                return min(size, point + len(text))
+            return point + index + 1
+        return point + index + 2
+
+    def outline(self, view):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.outlines.get(view.id())
+        if cached and now - cached[0] < self.OUTLINE_INTERVAL:
+            return cached[1]
+        titles = []
+        regions = view.find_all(HEADING_PATTERN, 0, '$0', titles)
+        outline = []
+        for region, title in zip(regions, titles):
+            level = len(title) - len(title.lstrip('#'))
+            outline.append((region.begin(), level, title[level:].strip().rstrip('#').rstrip()))
+        with self.lock:
+            self.outlines[view.id()] = (now, outline)
+        return outline
+
+    def forget(self, view_id):
+        with self.lock:
+            self.outlines.pop(view_id, None)
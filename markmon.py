@@ -1,25 +1,52 @@
 # coding=utf8
 
-import sublime
 import time
+IMPORT_STARTED = time.perf_counter()
+
+import sublime
 import sublime_plugin
-import webbrowser
 import subprocess
 import atexit
-import re
+import json
+import hashlib
+import binascii
 from .MarkmonListener import MarkmonListener
-import http.client
+from .transport import MarkmonConnectionPool, MarkmonSender, MarkmonChannel, ChannelUnsupported, UNIX_PREFIX
+from .delta import MarkmonChangeTracker
+from .timing import MarkmonTimings
+from .supervisor import MarkmonSupervisor, connect, process_exists
+from .eligibility import MarkmonEligibility
+from .largefile import MarkmonLargeFile
+from .cursor import MarkmonCursorSync
 from . import util
 import os
-from threading import Timer
+import socket
+import threading
 
-MARKDOWN_SYNTAX = re.compile(r'.*[Mm]arkdown.*')
+# seconds the import of this module (and the plugin modules it pulls in) may take
+IMPORT_TIME_BUDGET = 0.05
 
 markmon = None
 def plugin_loaded():
     """The ST3 entry point for plugins."""
+    if IMPORT_TIME > IMPORT_TIME_BUDGET:
+        print("Markmon took {:.0f}ms to import, over its {:.0f}ms budget.".format(
+            IMPORT_TIME * 1000, IMPORT_TIME_BUDGET * 1000))
+
+def get_markmon():
+    """Return the plugin instance, creating it on first use."""
     global markmon
-    markmon = Markmon(MarkmonListener.shared_plugin())
+    if markmon is None:
+        markmon = Markmon(MarkmonListener.shared_plugin())
+    return markmon
+
+def plugin_unloaded():
+    if markmon:
+        markmon.client.sender.stop()
+        markmon.client.cursor.stop()
+        markmon.client.close_channel()
+        markmon.server.worker.stop()
+        markmon.server.supervisor.close()
 
 class Markmon:
     def __init__(self, listener):
@@ -27,29 +54,91 @@ class Markmon:
         listener.load_settings()
 
         self.settings = MarkmonSettings()
-        self.client = MarkmonClient(self.settings)
-        self.server = MarkmonServer(self.settings)
+        self.connections = MarkmonConnectionPool(self.settings.token)
+        self.changes = MarkmonChangeTracker()
+        self.eligibility = MarkmonEligibility(self.settings)
+        self.client = MarkmonClient(self.settings, self.connections, self.changes, self.eligibility)
+        self.server = MarkmonServer(self.settings, self.connections)
+        self.scheduler = MarkmonScheduler(self.settings, self.client.view_updated)
         self.client.set_server(self.server)
+        self.server.set_client(self.client)
 
         listener.add_on_settings_change(self.settings_updated)
-        listener.add_on_modified(self.client.view_updated)
+        listener.add_on_modified(self.view_modified)
+        listener.add_on_saved(self.eligibility.forget)
+        listener.add_on_selection_modified(self.selection_modified)
+        listener.add_on_text_changed(self.text_changed)
+        listener.add_on_text_reset(self.changes.reset)
+        listener.add_on_close(self.view_closed)
+
+    def text_changed(self, view, changes):
+        if (self.settings.running and self.settings.settings["delta_updates"]
+                and self.eligibility.eligible(view)):
+            self.changes.record(view.buffer_id(), view.change_count(), changes)
+
+    def view_modified(self, view):
+        if self.settings.running and self.eligibility.eligible(view):
+            self.scheduler.view_modified(view)
+
+    def selection_modified(self, view):
+        if self.settings.running and self.eligibility.eligible(view):
+            self.client.selection_modified(view)
+            self.client.cursor.selection_modified(view)
+
+    def view_closed(self, view):
+        self.scheduler.cancel(view.id())
+        self.eligibility.forget(view, closed=True)
+        self.client.view_closed(view)
+        # View.clones is missing before Sublime Text 4, which records no changes
+        clones = getattr(view, 'clones', None)
+        if clones is None or not clones():
+            self.changes.discard(view.buffer_id())
+
+    def stats_report(self):
+        """Return the preview pipeline statistics as text."""
+        names = {}
+        for window in sublime.windows():
+            for view in window.views():
+                names[view.id()] = view.file_name() or view.name() or 'untitled'
+        lines = ["Markmon update timings", "", self.client.timings.report(names), ""]
+        stats = self.client.stats()
+        stats.update(self.server.supervisor.stats())
+        if self.server.preview:
+            stats.update(self.server.preview.stats())
+        lines.append("Counters")
+        lines.extend("  {:<20} {}".format(name, value) for name, value in sorted(stats.items()))
+        return "\n".join(lines) + "\n"
 
     def settings_updated(self, settings):
-        self.settings.update(settings)
-        self.server.setup_server()
+        changed = self.settings.update(settings)
+        if changed & {"syntaxes", "extensions"}:
+            self.eligibility.clear()
+        if not self.settings.running:
+            return
+        if changed & MarkmonSettings.RESTART_KEYS:
+            self.connections.close()
+            self.server.setup_server()
+        elif changed & self.settings.reconfigure_keys():
+            self.server.reconfigure()
+
+    def display_when_ready(self):
+        if self.server.wait_until_ready():
+            self.display()
+        else:
+            print("Markmon server did not accept connections on {}. Check your preferences.".format(self.settings.client_url))
 
     def display(self):
+        import webbrowser
         current_view = sublime.active_window().active_view()
         self.client.view_updated(current_view)
-        webbrowser.open("http://" + self.settings.client_url)
+        webbrowser.open("http://" + self.server.browser_url())
 
     def set_running(self, running):
         if running != self.settings.running:
             self.settings.running = running
             if running:
-                self.server.setup_server()
-                # need a delay to wait for the server to set up
-                Timer(1.0, self.display).start()
+                self.server.setup_server(
+                    lambda: threading.Thread(target=self.display_when_ready, daemon=True).start())
             else:
                 self.server.cleanup_server()
         elif running:
@@ -57,24 +146,73 @@ class Markmon:
 
 
 class MarkmonSettings:
+    # a change of these needs a new server
+    RESTART_KEYS = frozenset(("backend", "executable", "port", "socket_path", "projectdir"))
+    # a change of these is applied to the running server
+    RECONFIGURE_KEYS = frozenset(("command", "stylesheet", "render_blocks", "render_cache_size",
+                                  "render_workers", "converter_mode", "converter_max_jobs"))
+    # only the builtin backend reads these
+    BUILTIN_KEYS = frozenset(("render_blocks", "render_cache_size", "render_workers",
+                              "converter_mode", "converter_max_jobs"))
+
     def __init__(self):
         self.running = False
         self.settings = {}
         self.server_command = []
         self.client_url = ""
+        self.browser_url = ""
+        self.socket_path = None
+        # sent with every request so only this plugin can change its server
+        self.token = binascii.hexlify(os.urandom(16)).decode('ascii')
 
     def update(self, settings):
+        """Load settings and return the set of keys whose value changed."""
+        previous = self.settings
         self.settings = {
+            "backend": settings.get("backend", "markmon"),
             "executable": settings.get("executable", 'markmon'),
             "port": settings.get("port", 3000),
+            "socket_path": settings.get("socket_path", None),
             "command": settings.get("command", "pandoc -t HTML5"),
             "stylesheet": settings.get("stylesheet", None),
-            "projectdir": settings.get("projectdir", None)
+            "projectdir": settings.get("projectdir", None),
+            "debounce": settings.get("debounce", 150),
+            "max_latency": settings.get("max_latency", 1000),
+            "delta_updates": settings.get("delta_updates", False),
+            "startup_timeout": settings.get("startup_timeout", 10),
+            "render_blocks": settings.get("render_blocks", False),
+            "render_cache_size": settings.get("render_cache_size", 32),
+            "render_workers": settings.get("render_workers", 0),
+            "converter_mode": settings.get("converter_mode", "oneshot"),
+            "converter_max_jobs": settings.get("converter_max_jobs", 500),
+            "timing": settings.get("timing", False),
+            "stream_threshold": settings.get("stream_threshold", 1048576),
+            "syntaxes": settings.get("syntaxes", ["markdown"]),
+            "extensions": settings.get("extensions", []),
+            "large_file_threshold": settings.get("large_file_threshold", 5242880),
+            "large_file_window": settings.get("large_file_window", 50000),
+            "scroll_sync": settings.get("scroll_sync", True),
+            "scroll_sync_interval": settings.get("scroll_sync_interval", 50),
+            "channel": settings.get("channel", True)
         }
         self.build_strings()
+        return set(key for key, value in self.settings.items() if previous.get(key) != value)
+
+    def reconfigure_keys(self):
+        """Return the keys whose change the running backend has to be told about."""
+        if self.settings["backend"] == "builtin":
+            return self.RECONFIGURE_KEYS
+        return self.RECONFIGURE_KEYS - self.BUILTIN_KEYS
 
     def build_strings(self):
-        self.client_url = "localhost:{:d}".format(self.settings['port'])
+        self.socket_path = None
+        if self.settings["socket_path"]:
+            if self.settings["backend"] == "builtin" and hasattr(socket, "AF_UNIX"):
+                self.socket_path = os.path.expanduser(self.settings["socket_path"])
+            else:
+                print("Markmon only uses \"socket_path\" with the builtin backend on Linux and macOS.")
+        self.browser_url = "localhost:{:d}".format(self.settings['port'])
+        self.client_url = UNIX_PREFIX + self.socket_path if self.socket_path else self.browser_url
         self.server_command = [self.settings["executable"],
                                     "--port", str(self.settings['port']),
                                     "--command", self.settings['command']]
@@ -86,59 +224,728 @@ class MarkmonSettings:
             self.server_command.append("--projectdir")
             self.server_command.append(self.settings['projectdir'])
 
+class MarkmonScheduler:
+    """
+    Coalesce bursts of modifications into a single update per view.
+
+    An update is sent once a view has been quiet for the "debounce" period,
+    or once "max_latency" has passed since the first pending modification,
+    whichever comes first. The buffer is only read when the update fires,
+    so only the newest state of the view is ever sent.
+
+    """
+
+    def __init__(self, settings, callback):
+        self.settings = settings
+        self.callback = callback
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def view_modified(self, view):
+        delay = self.settings.settings.get("debounce", 0)
+        if delay <= 0:
+            self.callback(view)
+            return
+
+        now = time.monotonic()
+        view_id = view.id()
+        with self.lock:
+            entry = self.pending.get(view_id)
+            if entry:
+                entry[0] = view
+                entry[2] = now
+                return
+            self.pending[view_id] = [view, now, now]
+        sublime.set_timeout_async(lambda: self.flush(view_id), delay)
+
+    def flush(self, view_id):
+        delay = self.settings.settings.get("debounce", 0) / 1000.0
+        max_latency = self.settings.settings.get("max_latency", 0) / 1000.0
+        now = time.monotonic()
+        with self.lock:
+            entry = self.pending.get(view_id)
+            if not entry:
+                return
+            view, first, last = entry
+            wait = last + delay - now
+            if max_latency > 0:
+                wait = min(wait, first + max_latency - now)
+            if wait > 0:
+                sublime.set_timeout_async(lambda: self.flush(view_id), int(wait * 1000) + 1)
+                return
+            del self.pending[view_id]
+        self.callback(view)
+
+    def cancel(self, view_id):
+        with self.lock:
+            self.pending.pop(view_id, None)
+
+
+class MarkmonBufferReader:
+    """
+    Read a view as UTF-8 chunks for a streamed update.
+
+    Calling the reader starts reading the view over, region by region, so
+    only one chunk of the document is held in memory at a time. The md5
+    digest of everything read so far is kept in digest.
+
+    """
+
+    CHUNK = 1 << 18
+
+    def __init__(self, view, prefix, timer):
+        self.view = view
+        self.prefix = prefix
+        self.timer = timer
+        self.digest = None
+
+    def __call__(self):
+        self.digest = hashlib.md5()
+        return self.chunks()
+
+    def chunks(self):
+        chunk = self.prefix.encode('utf-8')
+        self.digest.update(chunk)
+        yield chunk
+        size = self.view.size()
+        for begin in range(0, size, self.CHUNK):
+            text = self.view.substr(sublime.Region(begin, min(begin + self.CHUNK, size)))
+            self.timer.mark('read')
+            chunk = text.encode('utf-8')
+            self.digest.update(chunk)
+            self.timer.mark('encode')
+            yield chunk
+
+
 class MarkmonClient:
-    def __init__(self, settings):
+    def __init__(self, settings, connections, changes, eligibility):
         self.settings = settings
+        self.connections = connections
+        self.changes = changes
+        self.eligibility = eligibility
         self.server = None
+        self.sender = MarkmonSender()
+        self.timings = MarkmonTimings(settings)
+        self.large_file = MarkmonLargeFile(settings)
+        self.cursor = MarkmonCursorSync(settings, connections, self.open_channel)
+        # buffer id -> view of the large documents previewed a window at a time
+        self.windowed = {}
+        self.channel = None
+        self.channel_lock = threading.Lock()
+        self.message_id = 0
+        # id of the last whole document or window sent over the channel
+        self.resync_id = 0
+        # message id -> (view, message type) of updates the server did not acknowledge yet
+        self.unacknowledged = {}
+        self.render_error = None
+        self.render_errors = 0
+        self.streamed_updates = 0
+        self.dedupe_hits = 0
+        self.dedupe_misses = 0
+        self.reset_document()
 
     def set_server(self, server):
         self.server = server
 
-    def view_updated(self, view, try_server=True):
-         if self.settings.running and MARKDOWN_SYNTAX.match(view.scope_name(0)):
+    def reset_document(self):
+        # (buffer id, revision) of the document the server currently holds
+        self.document = None
+        self.delta_supported = True
+        self.window_supported = True
+        self.channel_supported = True
+        self.close_channel()
+        # (buffer id, outline) last sent with a window
+        self.outline_sent = None
+        self.cursor.reset()
+        # view id -> (target, revision, content digest, window bounds) of the last update sent
+        self.sent = {}
+        self.current_view = None
+
+    def view_closed(self, view):
+        self.sent.pop(view.id(), None)
+        self.timings.discard(view.id())
+        self.large_file.forget(view.id())
+        self.cursor.forget(view.id())
+        if self.windowed.get(view.buffer_id()) is view:
+            del self.windowed[view.buffer_id()]
+
+    def is_current(self, view, revision, digest=None, points=None):
+        """
+        Return whether the server already shows this state of the view.
+
+        When a window of the view was sent, it only does if the points, the
+        ones the window is read around, all lie within that window.
+
+        """
+        if self.current_view != view.id():
+            return False
+        record = self.sent.get(view.id())
+        if not record or record[0] != self.settings.client_url:
+            return False
+        if record[3] is not None and not (points and within(record[3], points)):
+            return False
+        return record[1] == revision or (digest is not None and record[2] == digest)
+
+    def mark_sent(self, view, revision, digest=None, window=None):
+        self.sent[view.id()] = (self.settings.client_url, revision, digest, window)
+        self.current_view = view.id()
+
+    def selection_modified(self, view):
+        """Send another window when the caret or viewport moved out of the one last sent."""
+        record = self.sent.get(view.id())
+        if (record and record[3] is not None and self.current_view == view.id() and
+                not within(record[3], self.window_points(view))):
+            self.view_updated(view)
+
+    def stats(self):
+        return {
+            "dedupe_hits": self.dedupe_hits,
+            "dedupe_misses": self.dedupe_misses,
+            "dropped_updates": self.sender.dropped,
+            "streamed_updates": self.streamed_updates,
+            "render_errors": self.render_errors,
+            "unacknowledged": len(self.unacknowledged)
+        }
+
+    def open_channel(self):
+        """
+        Return the channel to the server, opening it when there is none.
+
+        Return None when updates go as HTTP requests instead: the "channel"
+        setting is off or the server does not offer a channel.
+
+        """
+        if not (self.settings.settings["channel"] and self.channel_supported):
+            return None
+        with self.channel_lock:
+            if self.channel is None or self.channel.closed:
+                try:
+                    self.channel = MarkmonChannel.open(self.settings.client_url, self.channel_message,
+                                                       self.settings.token)
+                except ChannelUnsupported:
+                    self.channel_supported = False
+                    self.channel = None
+            return self.channel
+
+    def close_channel(self):
+        with self.channel_lock:
+            channel, self.channel = self.channel, None
+        self.unacknowledged.clear()
+        if channel:
+            channel.close()
+
+    def deliver(self, view, message, body, request, timer):
+        """
+        Send an update over the channel, or with request() when there is none.
+
+        message and body make up the channel message; request sends the
+        HTTP request and returns its status. Return that status, or None for
+        a channel message, which is taken as accepted: a rejection arrives
+        later and is handled by channel_message().
+
+        """
+        channel = self.open_channel()
+        if channel is None:
+            return request()
+        timer.mark('connect')
+        self.message_id += 1
+        message["id"] = self.message_id
+        if message["type"] != "patch":
+            self.resync_id = self.message_id
+        self.unacknowledged[self.message_id] = (view, message["type"])
+        channel.send(message, body() if callable(body) else body)
+        timer.mark('send')
+        return None
+
+    def channel_message(self, message):
+        """Handle a message from the server; runs on the channel thread."""
+        kind = message.get("type")
+        if kind == "ack":
+            sent = self.unacknowledged.pop(message.get("id"), None)
+            status = message.get("status")
+            # a rejection before the last whole update was sent is moot
+            if sent and status not in (200, 204) and message["id"] >= self.resync_id:
+                view, sent_kind = sent
+                self.sender.submit(view.id(), lambda: self.rejected(view, sent_kind, status))
+        elif kind == "status":
+            self.render_reported(message)
+        elif kind == "closed":
+            self.unacknowledged.clear()
+            self.sender.submit("channel", self.channel_closed)
+
+    def rejected(self, view, kind, status):
+        """Recover from an update the server did not accept by sending the view again."""
+        if kind == "update":
+            print("Markmon server rejected an update with status {}.".format(status))
+            return
+        if kind == "window":
+            self.window_supported = False
+        elif status != 409:
+            self.delta_supported = False
+        self.document = None
+        self.current_view = None
+        self.send_view(view)
+
+    def channel_closed(self):
+        # updates may have been lost with the channel
+        self.document = None
+        self.current_view = None
+
+    def render_reported(self, status):
+        error = status.get("error")
+        if error:
+            self.render_errors += 1
+            if error != self.render_error:
+                print("Markmon converter failed: {}".format(error))
+        self.render_error = error
+        view_id = self.current_view
+        if view_id is not None and status.get("seconds") is not None:
+            self.timings.add(view_id, 'render', status["seconds"])
+
+    def view_updated(self, view):
+        """Queue an update of the preview; the network I/O runs on the sender thread."""
+        if self.settings.running and self.eligibility.eligible(view):
+            self.sender.submit(view.id(), lambda: self.send_view(view))
+
+    def send_view(self, view, try_server=True):
+         if self.settings.running:
+            large = self.large_file.applies(view)
+            if self.is_current(view, view.change_count(), points=self.window_points(view) if large else None):
+                self.dedupe_hits += 1
+                return
             try:
-                connection = http.client.HTTPConnection(self.settings.client_url)
-                # connection.request('PUT', '/', view.substr(sublime.Region(0, view.size())).encode('utf-8'))
-                openedfile_path = sublime.active_window().active_view().file_name()
-                shebang_comment = u'<!--FILEPATH:[' + openedfile_path + u'];-->'
-                payload = b"".join([shebang_comment.encode('utf-8'), view.substr(sublime.Region(0, view.size())).encode('utf-8')])
-                connection.request('PUT', '/', payload)
-                connection.getresponse()
+                if large:
+                    self.send_window(view)
+                elif not (self.settings.settings["delta_updates"] and self.send_delta(view)):
+                    self.send_full(view)
             except ConnectionRefusedError:
-                if self.server:
-                    if try_server:
-                        self.server.setup_server()
-                        time.sleep(1)
-                        self.view_updated(view, False)
-                    else:
-                        print("Markmon server is down. Check your preferences.")
+                if self.server and try_server and self.server.ensure_running():
+                    self.send_view(view, False)
+                else:
+                    print("Markmon server is down. Check your preferences.")
+
+    def send_full(self, view):
+        # the server drops the outline of a windowed document it no longer holds
+        self.outline_sent = None
+        timer = self.timings.timer()
+        revision = view.change_count()
+        openedfile_path = sublime.active_window().active_view().file_name() or u''
+        shebang_comment = u'<!--FILEPATH:[' + openedfile_path + u'];-->'
+        headers = {
+            "X-Markmon-Buffer": str(view.buffer_id()),
+            "X-Markmon-Revision": str(revision)
+        }
+        threshold = self.settings.settings["stream_threshold"]
+        if threshold and view.size() > threshold:
+            # the digest is only known once the buffer was sent
+            if self.is_current(view, revision):
+                self.dedupe_hits += 1
+                return
+            self.dedupe_misses += 1
+            self.streamed_updates += 1
+            reader = MarkmonBufferReader(view, shebang_comment, timer)
+            self.deliver(view, {"type": "update", "buffer": view.buffer_id(), "revision": revision}, reader,
+                         lambda: self.connections.request(self.settings.client_url, 'PUT', '/', reader,
+                                                          headers, timer)[0], timer)
+            digest = reader.digest.hexdigest()
+        else:
+            text = view.substr(sublime.Region(0, view.size()))
+            timer.mark('read')
+            payload = [shebang_comment.encode('utf-8'), text.encode('utf-8')]
+            del text
+            md5 = hashlib.md5(payload[0])
+            md5.update(payload[1])
+            digest = md5.hexdigest()
+            timer.mark('encode')
+            if self.is_current(view, revision, digest):
+                self.dedupe_hits += 1
+                self.mark_sent(view, revision, digest)
+                return
+            self.dedupe_misses += 1
+            headers["Content-Length"] = str(len(payload[0]) + len(payload[1]))
+            self.deliver(view, {"type": "update", "buffer": view.buffer_id(), "revision": revision}, payload,
+                         lambda: self.connections.request(self.settings.client_url, 'PUT', '/', payload,
+                                                          headers, timer)[0], timer)
+        self.timings.record(view, timer)
+
+        # an edit landing while the buffer was read leaves the revision unknown
+        if view.change_count() == revision:
+            self.document = (view.buffer_id(), revision)
+            self.changes.rebase(view.buffer_id(), revision)
+            self.mark_sent(view, revision, digest)
+        else:
+            self.document = None
+            self.current_view = None
+
+    def send_window(self, view):
+        """
+        Send the blocks around the viewport and cursor of a large document.
+
+        The server gets the window with its position in the document and the
+        heading outline, and asks for more with window_source(). Servers
+        without PUT /window are sent the window alone as the document.
+
+        """
+        timer = self.timings.timer()
+        revision = view.change_count()
+        begin, end, text = self.large_file.around(view, self.window_points(view))
+        outline = self.large_file.outline(view)
+        timer.mark('read')
+        path = view.file_name() or u''
+        headers = {
+            "X-Markmon-Buffer": str(view.buffer_id()),
+            "X-Markmon-Revision": str(revision)
+        }
+        self.windowed[view.buffer_id()] = view
+        status = None
+        if self.window_supported:
+            window = {
+                "path": path,
+                "buffer": view.buffer_id(),
+                "revision": revision,
+                "begin": begin,
+                "end": end,
+                "line": view.rowcol(begin)[0],
+                "size": view.size(),
+                "text": text
+            }
+            if self.outline_sent != (view.buffer_id(), outline):
+                window["outline"] = outline
+                self.outline_sent = (view.buffer_id(), outline)
+
+            def request():
+                payload = json.dumps(window).encode('utf-8')
+                timer.mark('encode')
+                headers["Content-Type"] = "application/json"
+                return self.connections.request(self.settings.client_url, 'PUT', '/window', payload,
+                                                headers, timer)[0]
+
+            message = dict(window, type="window")
+            body = message.pop("text").encode('utf-8')
+            timer.mark('encode')
+            status = self.deliver(view, message, body, request, timer)
+            self.window_supported = status in (None, 200, 204)
+        if not self.window_supported:
+            payload = (u'<!--FILEPATH:[' + path + u'];-->' + text).encode('utf-8')
+            timer.mark('encode')
+            headers.pop("Content-Type", None)
+            self.deliver(view, {"type": "update", "buffer": view.buffer_id(), "revision": revision}, payload,
+                         lambda: self.connections.request(self.settings.client_url, 'PUT', '/', payload,
+                                                          headers, timer)[0], timer)
+        self.timings.record(view, timer)
+        # the server holds a window, which deltas cannot be applied to
+        self.document = None
+        self.mark_sent(view, revision, window=(begin, end))
+
+    def window_points(self, view):
+        """Return the points a window of the view must contain: its visible region and caret."""
+        visible = view.visible_region()
+        points = [visible.begin(), visible.end()]
+        selection = view.sel()
+        if len(selection):
+            points.append(selection[0].b)
+        return points
+
+    def window_source(self, buffer_id, point, direction):
+        """Return (begin, end, text) of the window before, after or around point, or None."""
+        view = self.windowed.get(buffer_id)
+        if not view or not view.is_valid():
+            return None
+        point = max(0, min(point, view.size()))
+        if direction == 'before':
+            return self.large_file.before(view, point)
+        if direction == 'after':
+            return self.large_file.after(view, point)
+        return self.large_file.around(view, [point])
+
+    def send_delta(self, view):
+        """
+        Send only the changes since the revision the server holds.
+
+        Return False when a full update is needed instead: the server holds
+        another buffer or an unknown revision, the changes since then were
+        not all recorded, or the server rejected the delta. A 409 response
+        asks for a full resync; any other failure disables deltas until the
+        server is restarted. Over the channel the delta is taken as accepted
+        and a rejection is handled by rejected() once it is acknowledged.
+
+        """
+        if not self.delta_supported or self.document is None:
+            return False
+        timer = self.timings.timer()
+        buffer_id, base = self.document
+        if buffer_id != view.buffer_id():
+            return False
+        delta = self.changes.delta(buffer_id, base)
+        if delta is None:
+            return False
+        revision, changes = delta
+        if not changes:
+            return True
+        timer.mark('read')
+
+        self.dedupe_misses += 1
+        openedfile_path = sublime.active_window().active_view().file_name() or u''
+        delta = {
+            "path": openedfile_path,
+            "buffer": buffer_id,
+            "base": base,
+            "revision": revision,
+            "changes": changes
+        }
+
+        def request():
+            payload = json.dumps(delta).encode('utf-8')
+            timer.mark('encode')
+            return self.connections.request(self.settings.client_url, 'PATCH', '/', payload,
+                                            {"Content-Type": "application/json"}, timer)[0]
+
+        status = self.deliver(view, dict(delta, type="patch"), b'', request, timer)
+        self.timings.record(view, timer)
+        if status in (None, 204):
+            self.document = (buffer_id, revision)
+            self.changes.rebase(buffer_id, revision)
+            self.mark_sent(view, revision)
+            return True
+        if status != 409:
+            self.delta_supported = False
+        self.document = None
+        return False
+
+def within(bounds, points):
+    return all(bounds[0] <= point <= bounds[1] for point in points)
+
 
 class MarkmonServer:
-    def __init__(self, settings):
+    # seconds a terminated server process gets to exit before it is killed
+    REAP_TIMEOUT = 2.0
+
+    def __init__(self, settings, connections):
         self.server_url = None
         self.settings = settings
-        atexit.register(self.cleanup_server)
+        self.connections = connections
+        self.client = None
+        self.process = None
+        self.preview = None
+        # the address claim() recorded for the running server
+        self.claimed = None
+        self.supervisor = MarkmonSupervisor(settings, self)
+        # starts, stops and reconfigurations can take seconds, so they run here and not on the UI thread
+        self.worker = MarkmonSender("markmon-server")
+        atexit.register(self.supervisor.close)
 
-    def setup_server(self, _=None):
-        try:
-            self.cleanup_server()
-        except:
-            pass
-        if not self.settings.running:
-            return
+    def set_client(self, client):
+        self.client = client
+
+    def setup_server(self, then=None):
+        """Replace the server with a new one on the worker thread, then call then()."""
+        def start():
+            try:
+                self.supervisor.start()
+            except OSError:
+                # launch() printed what went wrong
+                pass
+            if then:
+                then()
+        self.worker.submit("server", start)
+
+    def ensure_running(self):
+        return self.supervisor.ensure_running()
+
+    def wait_until_ready(self):
+        return self.supervisor.wait_until_ready()
+
+    def browser_url(self):
+        """Return host:port of the preview page; the builtin server may have picked the port."""
+        if self.preview:
+            return "localhost:{:d}".format(self.preview.port)
+        return self.settings.browser_url
+
+    def cleanup_server(self):
+        self.worker.submit("server", self.supervisor.stop)
+
+    def launch(self):
+        """Start a server for the current settings; called by the supervisor."""
+        if self.client:
+            self.client.reset_document()
         self.server_url = self.settings.client_url
+        if self.settings.settings["backend"] == "builtin":
+            self.setup_builtin_server()
+            return
         env = os.environ.copy()
         betterenv = util.create_environment()
         env["PATH"] = betterenv["PATH"]
+        env["MARKMON_TOKEN"] = self.settings.token
+        command = list(self.settings.server_command)
+        command[0] = self.resolve(command[0], "executable")
         try:
-            subprocess.Popen(self.settings.server_command, env=env)
+            self.process = subprocess.Popen(command, env=env)
         except FileNotFoundError as e:
             print("Markmon Server failed to initialize. Confirm executable path is correct in Markmon Setting. Command used:")
-            print(self.settings.server_command)
+            print(command)
             raise
+        self.claim(self.supervisor.address, self.process.pid)
 
-    def cleanup_server(self):
+    def resolve(self, executable, setting):
+        path = util.resolve_executable(executable)
+        if not path:
+            message = "Markmon could not find \"{}\" (from the \"{}\" setting) on PATH: {}".format(
+                executable, setting, util.create_environment().get("PATH", ""))
+            print(message)
+            raise FileNotFoundError(message)
+        return path
+
+    def make_builtin_renderer(self):
+        from .preview.render import make_renderer, split_command
+        command = split_command(self.settings.settings["command"])
+        command[0] = self.resolve(command[0], "command")
+        return make_renderer(command, util.popen,
+                             self.settings.settings["render_blocks"],
+                             self.settings.settings["render_cache_size"] << 20,
+                             self.settings.settings["render_workers"],
+                             self.settings.settings["converter_mode"],
+                             self.settings.settings["converter_max_jobs"])
+
+    def setup_builtin_server(self):
+        from .preview.server import PreviewServer
+        self.process = None
+        renderer = self.make_builtin_renderer()
+        self.preview = PreviewServer(self.settings.settings["port"], renderer,
+                                     self.settings.settings["stylesheet"],
+                                     self.settings.settings["projectdir"],
+                                     socket_path=self.settings.socket_path,
+                                     token=self.settings.token)
+        if self.client:
+            self.preview.source = self.client.window_source
+        try:
+            self.preview.start()
+            self.claim(self.supervisor.address, os.getpid())
+        except OSError as e:
+            self.preview = None
+            print("Markmon builtin server failed to listen on {} ({}). Check the port and socket_path in Markmon Setting.".format(
+                " and ".join(filter(None, (self.settings.browser_url, self.settings.socket_path))), e))
+            raise
+
+    def reconfigure(self):
+        self.worker.submit("reconfigure", self.apply_reconfiguration)
+
+    def apply_reconfiguration(self):
+        """
+        Apply converter and stylesheet changes to the running server.
+
+        The builtin server swaps its renderer in place. The markmon server
+        is sent the new command and stylesheet with POST /reconfigure and
+        is restarted only if it does not accept them.
+
+        """
+        if self.preview:
+            self.preview.reconfigure(self.make_builtin_renderer(), self.settings.settings["stylesheet"])
+            return
+        status = None
         if self.server_url:
-            connection = http.client.HTTPConnection(self.server_url)
-            connection.request('DELETE', '/')
-            connection.getresponse()
+            body = json.dumps({
+                "command": self.settings.settings["command"],
+                "stylesheet": self.settings.settings["stylesheet"]
+            }).encode('utf-8')
+            try:
+                status, _ = self.connections.request(self.server_url, 'POST', '/reconfigure', body,
+                                                     {"Content-Type": "application/json"})
+            except OSError:
+                pass
+        if status not in (200, 204):
+            self.connections.close()
+            self.setup_server()
+
+    def alive(self):
+        if self.preview:
+            return self.preview.running
+        return self.process is not None and self.process.poll() is None
+
+    def reap(self):
+        """Stop the server and wait for its process to exit."""
+        self.connections.close()
+        if self.claimed is not None:
+            self.disclaim(self.claimed)
+            self.claimed = None
+        if self.client:
+            self.client.close_channel()
+        if self.preview:
+            preview, self.preview = self.preview, None
+            preview.stop()
+        if self.process:
+            process, self.process = self.process, None
+            process.terminate()
+            try:
+                process.wait(self.REAP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def owner_path(self, address):
+        """Return the file recording which editor started the server on address."""
+        name = str(address) if isinstance(address, int) else hashlib.md5(address.encode('utf-8')).hexdigest()
+        return os.path.join(sublime.cache_path(), 'Markmon', 'server-{}.json'.format(name))
+
+    def claim(self, address, pid):
+        """Record that this editor started the server with process id pid on address."""
+        self.claimed = address
+        path = self.owner_path(address)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf8') as f:
+                json.dump({"editor": os.getpid(), "pid": pid, "token": self.settings.token}, f)
+        except OSError:
+            pass
+
+    def owner(self, address):
+        try:
+            with open(self.owner_path(address), encoding='utf8') as f:
+                owner = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return owner if isinstance(owner, dict) else None
+
+    def disclaim(self, address):
+        owner = self.owner(address)
+        if owner and owner.get("token") == self.settings.token:
+            try:
+                os.unlink(self.owner_path(address))
+            except OSError:
+                pass
+
+    def evict(self, address):
+        """
+        Ask a server an earlier run of the plugin left on address to shut down.
+
+        Only a server started by this editor, or by one that is gone, is
+        evicted, and only while the process claim() recorded still runs;
+        otherwise whatever listens on address is not that server. Return
+        whether address is free now.
+
+        """
+        owner = self.owner(address)
+        if (not owner or not process_exists(owner.get("pid")) or
+                (owner.get("editor") != os.getpid() and process_exists(owner.get("editor")))):
+            print("Markmon found a server it did not start on {}. Pick another port or socket_path in Markmon Setting.".format(address))
+            return False
+        import http.client
+        connection = http.client.HTTPConnection("localhost", timeout=1)
+        try:
+            connection.sock = connect(address, 1)
+            connection.request('DELETE', '/', headers={"X-Markmon-Token": owner.get("token", "")})
+            connection.getresponse().read()
+        except (http.client.HTTPException, OSError):
+            pass
+        finally:
+            connection.close()
+        deadline = time.monotonic() + self.REAP_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                connect(address, 0.1).close()
+            except OSError:
+                return True
+            time.sleep(0.05)
+        print("Markmon found another server on {} that does not shut down.".format(address))
+        return False
+
+IMPORT_TIME = time.perf_counter() - IMPORT_STARTED
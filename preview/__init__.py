@@ -0,0 +1,10 @@
+# coding=utf8
+
+"""
+The builtin preview server.
+
+These modules live in a subpackage so Sublime Text does not import them
+(and the standard library modules they need) when it loads the plugin;
+markmon.py imports them on first use of the builtin backend.
+
+"""
@@ -0,0 +1,81 @@
+# coding=utf8
+
+"""
+Framing of the persistent channel between the plugin and the preview server.
+
+The plugin opens the channel with POST /channel and "Upgrade:
+markmon-channel"; after the 101 response both sides exchange frames. A
+frame is two big-endian 32-bit lengths followed by a JSON message and a
+body of that many bytes. A message with "more" set is continued by
+{"type": "more"} frames whose bodies are appended to it, the last of which
+has no "more".
+
+"""
+
+import json
+import struct
+
+UPGRADE = 'markmon-channel'
+
+FRAME_HEADER = struct.Struct('>II')
+
+
+def write_frame(send, message, body=b''):
+    """Write one frame with send, a function like socket.sendall."""
+    data = json.dumps(message).encode('utf-8')
+    send(FRAME_HEADER.pack(len(data), len(body)) + data)
+    if body:
+        send(body)
+
+
+def write_message(send, message, body=b''):
+    """Write a message whose body is bytes or an iterable of bytes chunks."""
+    if isinstance(body, bytes):
+        write_frame(send, message, body)
+        return
+    chunks = iter(body)
+    chunk = next(chunks, b'')
+    for following in chunks:
+        write_frame(send, dict(message, more=True), chunk)
+        message = {"type": "more"}
+        chunk = following
+    write_frame(send, message, chunk)
+
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        # the other side closed the channel
+        return None
+    return data
+
+
+def read_frame(stream):
+    """Return the next (message, body) from a buffered binary stream, or None at its end."""
+    header = read_exactly(stream, FRAME_HEADER.size)
+    if header is None:
+        return None
+    message_size, body_size = FRAME_HEADER.unpack(header)
+    data = read_exactly(stream, message_size)
+    body = read_exactly(stream, body_size) if body_size else b''
+    if data is None or body is None:
+        return None
+    return json.loads(data.decode('utf-8')), body
+
+
+def read_message(stream):
+    """Return the next whole (message, body), joining continued frames, or None at the end."""
+    frame = read_frame(stream)
+    if frame is None or not frame[0].get("more"):
+        return frame
+    message, body = frame
+    chunks = [body]
+    while True:
+        frame = read_frame(stream)
+        if frame is None:
+            return None
+        chunks.append(frame[1])
+        if not frame[0].get("more"):
+            break
+    message.pop("more", None)
+    return message, b''.join(chunks)
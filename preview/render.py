@@ -0,0 +1,442 @@
+# coding=utf8
+
+"""
+Markdown rendering for the builtin preview server.
+
+This module only depends on the standard library so the preview server can
+also run outside of Sublime Text.
+
+"""
+
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+
+if __package__:
+    from .workers import WorkerPool, WorkerError, WorkerInterrupted
+else:
+    from workers import WorkerPool, WorkerError, WorkerInterrupted
+
+FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+HEADING_RE = re.compile(r'^ {0,3}#{1,6}(\s|$)')
+LIST_ITEM_RE = re.compile(r'^ {0,3}([*+-]|\d+[.)])(\s|$)')
+REFERENCE_RE = re.compile(r'^ {0,3}\[[^\]^][^\]]*\]:\s')
+FOOTNOTE_RE = re.compile(r'^ {0,3}\[\^[^\]]+\]:', re.MULTILINE)
+
+BLOCK_SEPARATOR = '\n\n<!--markmon-block-->\n\n'
+BLOCK_SEPARATOR_RE = re.compile(r'\s*<!--markmon-block-->\s*')
+
+# put before each block of a tracked render so browsers can find it
+BLOCK_MARKER = '<span class="markmon-block" data-block="{}"></span>\n'
+
+
+def split_command(command):
+    """Split a converter command line into an argument list."""
+    return shlex.split(command, posix=(os.name != 'nt'))
+
+
+def default_popen(args):
+    """Start a converter process with piped stdin, stdout and stderr."""
+    return subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+class ConverterError(Exception):
+    pass
+
+
+class RenderCancelled(Exception):
+    pass
+
+
+class RenderJob:
+    """
+    A render of one document revision.
+
+    Converter processes working for the job register themselves so that
+    cancel() can kill them as soon as a newer revision arrives.
+
+    """
+
+    def __init__(self, revision=None):
+        self.revision = revision
+        self.started = time.monotonic()
+        self.cancelled = False
+        self.processes = set()
+        self.killed_processes = set()
+        self.lock = threading.Lock()
+
+    def register(self, process):
+        with self.lock:
+            if not self.cancelled:
+                self.processes.add(process)
+                return
+            self.killed_processes.add(process)
+        kill(process)
+
+    def unregister(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            processes, self.processes = self.processes, set()
+            self.killed_processes.update(processes)
+        for process in processes:
+            kill(process)
+
+    def killed(self, process):
+        """Return whether cancel() killed process."""
+        with self.lock:
+            return process in self.killed_processes
+
+    def check(self):
+        if self.cancelled:
+            raise RenderCancelled()
+
+
+def kill(process):
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+
+def convert(popen, args, text, job=None):
+    """Run the converter on text and return the resulting HTML."""
+    if job:
+        job.check()
+    process = popen(args)
+    if process is None:
+        raise ConverterError("Could not start converter: {}".format(" ".join(args)))
+    if job:
+        job.register(process)
+    try:
+        out, err = process.communicate(text.encode('utf-8'))
+    except OSError as e:
+        if job:
+            job.check()
+        raise ConverterError("Converter failed: {}".format(e))
+    finally:
+        if job:
+            job.unregister(process)
+    if job:
+        job.check()
+    if process.returncode:
+        raise ConverterError((err or b'').decode('utf-8', 'replace') or
+                             "Converter exited with status {}".format(process.returncode))
+    return out.decode('utf-8', 'replace')
+
+
+class Renderer:
+    """
+    Render whole documents with the configured converter command.
+
+    With a worker mode ("stream" or "pandoc-server") documents go to a pool
+    of long-lived converter processes; a conversion falls back to starting
+    the command once if a worker fails, and the pool is abandoned after
+    MAX_WORKER_FAILURES failures in a row.
+
+    """
+
+    MAX_WORKER_FAILURES = 3
+
+    # whole documents have no blocks to index
+    index = None
+
+    def __init__(self, command, popen=None, mode="oneshot", pool_size=1, max_jobs=500):
+        # command is a command line or an already split argument list
+        self.args = split_command(command) if isinstance(command, str) else list(command)
+        self.popen = popen or default_popen
+        self.pool = None
+        self.worker_failures = 0
+        if mode != "oneshot":
+            self.pool = WorkerPool(self.popen, self.args, mode, pool_size, max_jobs)
+
+    def render(self, text, job=None, track=False):
+        return self.convert(text, job)
+
+    def convert(self, text, job=None):
+        pool = self.pool
+        if pool:
+            try:
+                out = pool.convert(text, job)
+                self.worker_failures = 0
+                return out
+            except WorkerInterrupted:
+                # the worker was fine until the cancelled render killed it
+                job.check()
+            except WorkerError as e:
+                print("Markmon converter worker failed: {}".format(e))
+                self.worker_failures += 1
+                if self.worker_failures >= self.MAX_WORKER_FAILURES:
+                    print("Markmon is falling back to starting the converter for every render.")
+                    self.pool = None
+                    pool.close()
+                if job:
+                    job.check()
+        return convert(self.popen, self.args, text, job)
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+
+
+def split_blocks(text):
+    """
+    Split a Markdown document into top-level blocks.
+
+    Return a list of (first line number, block text) tuples. Fenced code,
+    $$ math blocks and front matter are kept whole, headings are blocks of
+    their own and paragraphs end at blank lines, except where the next line
+    is indented or continues a loose list.
+
+    """
+    lines = text.split('\n')
+    blocks = []
+    current = []
+    start = 0
+    i = 0
+
+    def flush():
+        if current:
+            blocks.append((start, '\n'.join(current)))
+            del current[:]
+
+    while i < len(lines):
+        line = lines[i]
+        fence = FENCE_RE.match(line)
+        stripped = line.strip()
+        closing = None
+
+        if fence:
+            marker = fence.group(1)
+            closing = lambda l: l.strip().startswith(marker[0] * len(marker)) and not l.strip().strip(marker[0])
+        elif stripped.startswith('$$') and not (len(stripped) > 2 and stripped.endswith('$$')):
+            closing = lambda l: l.strip().endswith('$$')
+        elif i == 0 and stripped == '---':
+            closing = lambda l: l.strip() in ('---', '...')
+
+        if closing:
+            flush()
+            start = i
+            current.append(line)
+            i += 1
+            while i < len(lines):
+                current.append(lines[i])
+                i += 1
+                if closing(current[-1]):
+                    break
+            flush()
+        elif HEADING_RE.match(line):
+            flush()
+            start = i
+            current.append(line)
+            flush()
+            i += 1
+        elif not stripped:
+            if current:
+                following = i + 1
+                while following < len(lines) and not lines[following].strip():
+                    following += 1
+                if following < len(lines) and (
+                        lines[following][:1] in (' ', '\t') and not FENCE_RE.match(lines[following]) or
+                        LIST_ITEM_RE.match(current[0]) and LIST_ITEM_RE.match(lines[following])):
+                    current.extend(lines[i:following])
+                    i = following
+                    continue
+                flush()
+            i += 1
+        else:
+            if not current:
+                start = i
+            current.append(line)
+            i += 1
+    flush()
+    return blocks
+
+
+class BlockIndex:
+    """
+    Map source lines to the blocks of the last tracked render.
+
+    The index is the list of block start lines the render split the
+    document into anyway, so it is replaced, not rebuilt, on every render
+    and holds no text or HTML of its own; lookups bisect it.
+
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.end = 0
+        self.lock = threading.Lock()
+
+    def update(self, starts, end):
+        with self.lock:
+            self.starts = starts
+            self.end = end
+
+    def lookup(self, line):
+        """Return (block, fraction of the block above line), or None before the first render."""
+        with self.lock:
+            starts, end = self.starts, self.end
+        if not starts:
+            return None
+        block = max(0, bisect_right(starts, line) - 1)
+        following = starts[block + 1] if block + 1 < len(starts) else end
+        fraction = (line - starts[block]) / max(1, following - starts[block])
+        return block, max(0.0, min(1.0, fraction))
+
+
+class BlockCache:
+    """A least recently used cache of rendered blocks, capped by size in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+            return html
+
+    def put(self, key, html):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = html
+            self.size += len(key) + len(html)
+            while self.size > self.max_bytes and self.entries:
+                old_key, old_html = self.entries.popitem(last=False)
+                self.size -= len(old_key) + len(old_html)
+
+
+def cpu_count():
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+class BlockRenderer(Renderer):
+    """
+    Render documents block by block, converting only blocks that changed.
+
+    Each block is cached by the hash of its text. Link reference definitions
+    are appended to the blocks that may use them so reference-style links
+    keep working across blocks.
+
+    Blocks that need converting are split into one batch per worker and the
+    batches are converted concurrently, each by its own converter process.
+    Blocks in a batch are joined with an HTML comment that converters pass
+    through, so one process converts many blocks; if the output cannot be
+    split back into blocks the batch is converted one block at a time.
+
+    A tracked render, the one the preview shows, marks each block in its
+    HTML and records the lines the blocks start on in index.
+
+    Documents with footnote definitions are converted whole: footnotes
+    are numbered and collected at the end of the document, which blocks
+    converted on their own cannot do.
+
+    """
+
+    def __init__(self, command, popen=None, cache_bytes=32 << 20, workers=0, mode="oneshot", max_jobs=500):
+        self.workers = workers if workers > 0 else cpu_count()
+        super().__init__(command, popen, mode, self.workers, max_jobs)
+        self.cache = BlockCache(cache_bytes)
+        self.index = BlockIndex()
+        self.executor = None
+        if self.workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def render(self, text, job=None, track=False):
+        if FOOTNOTE_RE.search(text):
+            if track:
+                # without blocks the preview scrolls proportionally
+                self.index.update([], 0)
+            return self.convert(text, job)
+        blocks = split_blocks(text)
+        references = '\n'.join(line for line in text.split('\n') if REFERENCE_RE.match(line))
+
+        sources = []
+        for _, block in blocks:
+            if references and '[' in block:
+                block = block + '\n\n' + references
+            sources.append(block)
+        keys = [hashlib.sha1(source.encode('utf-8')).hexdigest() for source in sources]
+
+        html = [self.cache.get(key) for key in keys]
+        missing = [index for index, block in enumerate(html) if block is None]
+        batches = self.batches(missing)
+        results = self.map(lambda batch: self.convert_batch(batch, job),
+                           [[sources[index] for index in batch] for batch in batches])
+        for batch, converted in zip(batches, results):
+            if converted is None:
+                continue
+            for index, block in zip(batch, converted):
+                html[index] = block
+                self.cache.put(keys[index], block)
+        if job:
+            # blocks converted before the cancellation stay in the cache
+            job.check()
+        if track:
+            if blocks:
+                last_start, last_block = blocks[-1]
+                self.index.update([start for start, _ in blocks], last_start + last_block.count('\n') + 1)
+            else:
+                self.index.update([], 0)
+            return ''.join(BLOCK_MARKER.format(index) + block + '\n' for index, block in enumerate(html))
+        return '\n'.join(html)
+
+    def batches(self, indexes):
+        """Split indexes into at most one contiguous batch per worker."""
+        count = min(self.workers, len(indexes))
+        batches = []
+        for n in range(count):
+            batch = indexes[len(indexes) * n // count:len(indexes) * (n + 1) // count]
+            if batch:
+                batches.append(batch)
+        return batches
+
+    def map(self, function, items):
+        if self.executor and len(items) > 1:
+            return list(self.executor.map(function, items))
+        return [function(item) for item in items]
+
+    def convert_batch(self, sources, job=None):
+        """Convert a batch of blocks; return None if the job was cancelled."""
+        try:
+            if len(sources) == 1:
+                return [self.convert(sources[0], job)]
+            output = self.convert(BLOCK_SEPARATOR.join(sources), job)
+            blocks = BLOCK_SEPARATOR_RE.split(output.strip())
+            if len(blocks) != len(sources):
+                return [self.convert(source, job) for source in sources]
+            return blocks
+        except RenderCancelled:
+            return None
+
+    def close(self):
+        super().close()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+
+def make_renderer(command, popen=None, blocks=False, cache_bytes=32 << 20, workers=0,
+                  mode="oneshot", max_jobs=500):
+    if blocks:
+        return BlockRenderer(command, popen, cache_bytes, workers, mode, max_jobs)
+    return Renderer(command, popen, mode, 1, max_jobs)
@@ -0,0 +1,900 @@
+# coding=utf8
+
+"""
+A markmon compatible preview server written against the standard library.
+
+It accepts the same requests as the markmon Node server (PUT / with the
+document, DELETE / to shut down) plus PATCH / deltas, PUT /window with a
+window of a large document and POST /cursor with the editor position, renders
+documents with the configured converter command and pushes the HTML to
+browsers over Server-Sent Events. POST /channel upgrades to a persistent
+channel that carries the same updates without a round-trip each (see
+channel.py).
+
+The server runs inside the plugin (see MarkmonServer) but can also be
+started on its own:
+
+    python3 preview/server.py --port 3002 --command "pandoc -t HTML5"
+
+Given --token, or $MARKMON_TOKEN, it only accepts updates that carry the
+token in an X-Markmon-Token header.
+
+"""
+
+import argparse
+import errno
+import hmac
+import http.server
+import json
+import mimetypes
+import os
+import queue
+import re
+import socket
+import socketserver
+import stat
+import threading
+import time
+import traceback
+from urllib.parse import parse_qs, unquote
+
+if __package__:
+    from .render import make_renderer, ConverterError, RenderCancelled, RenderJob
+    from .channel import UPGRADE, read_message, write_frame
+else:
+    from render import make_renderer, ConverterError, RenderCancelled, RenderJob
+    from channel import UPGRADE, read_message, write_frame
+
+FILEPATH_RE = re.compile(r'^<!--FILEPATH:\[(?P<path>.*?)\];-->')
+
+# events for the plugin's channels only, not for browsers
+CHANNEL_EVENTS = ('status',)
+
+STYLESHEET_URL = '/markmon-stylesheet.css'
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>markmon</title>
+<style>
+#outline {{ display: none; position: fixed; top: 0; bottom: 0; left: 0; width: 16em;
+           overflow: auto; padding: 0.5em; font-size: 0.85em; }}
+#outline a {{ display: block; text-decoration: none; }}
+body.markmon-outline {{ margin-left: 17.5em; }}
+.markmon-more {{ display: none; color: #888; font-size: 0.85em; }}
+</style>
+{stylesheet}
+<script type="text/x-mathjax-config">
+MathJax.Hub.Config({{messageStyle: "none"}});
+</script>
+<script src="https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.9/MathJax.js?config=TeX-AMS_HTML"></script>
+</head>
+<body>
+<nav id="outline"></nav>
+<div id="before" class="markmon-more">&hellip;</div>
+<div id="content">{content}</div>
+<div id="after" class="markmon-more">&hellip;</div>
+<script>
+(function () {{
+    var content = document.getElementById('content');
+    var outline = document.getElementById('outline');
+    var before = document.getElementById('before');
+    var after = document.getElementById('after');
+    // the part of a large document shown, null when the whole document is
+    var bounds = null;
+    var loading = false;
+    var lastY = window.pageYOffset;
+
+    function typeset(element) {{
+        if (window.MathJax) {{
+            MathJax.Hub.Queue(['Typeset', MathJax.Hub, element]);
+        }}
+    }}
+
+    function setBounds(part) {{
+        bounds = part;
+        before.style.display = bounds && bounds.begin > 0 ? 'block' : 'none';
+        after.style.display = bounds && bounds.end < bounds.size ? 'block' : 'none';
+    }}
+
+    function setOutline(entries) {{
+        outline.innerHTML = '';
+        outline.style.display = entries.length ? 'block' : 'none';
+        document.body.className = entries.length ? 'markmon-outline' : '';
+        entries.forEach(function (entry) {{
+            var link = document.createElement('a');
+            link.href = '#';
+            link.textContent = entry[2];
+            link.style.paddingLeft = (entry[1] - 1) + 'em';
+            link.onclick = function () {{
+                load('around', entry[0]);
+                return false;
+            }};
+            outline.appendChild(link);
+        }});
+    }}
+
+    // fetch more of a large document from the server as the preview scrolls
+    function load(direction, point) {{
+        if (loading || !bounds) {{
+            return;
+        }}
+        loading = true;
+        var request = new XMLHttpRequest();
+        request.open('GET', '/window?direction=' + direction + '&point=' + point);
+        request.onload = function () {{
+            loading = false;
+            if (request.status !== 200) {{
+                return;
+            }}
+            var part = JSON.parse(request.responseText);
+            var element = document.createElement('div');
+            element.innerHTML = part.html;
+            if (direction === 'before') {{
+                var height = document.documentElement.scrollHeight;
+                content.insertBefore(element, content.firstChild);
+                window.scrollBy(0, document.documentElement.scrollHeight - height);
+                setBounds({{begin: part.begin, end: bounds.end, size: part.size}});
+            }} else if (direction === 'after') {{
+                content.appendChild(element);
+                setBounds({{begin: bounds.begin, end: part.end, size: part.size}});
+            }} else {{
+                content.innerHTML = '';
+                content.appendChild(element);
+                setBounds(part);
+                window.scrollTo(0, 0);
+            }}
+            typeset(element);
+        }};
+        request.onerror = function () {{
+            loading = false;
+        }};
+        request.send();
+    }}
+
+    window.addEventListener('scroll', function () {{
+        var y = window.pageYOffset;
+        if (bounds && y < lastY && y < 100 && bounds.begin > 0) {{
+            load('before', bounds.begin);
+        }} else if (bounds && y > lastY && bounds.end < bounds.size &&
+                   y + window.innerHeight > document.documentElement.scrollHeight - 200) {{
+            load('after', bounds.end);
+        }}
+        lastY = y;
+    }});
+
+    var source = new EventSource('/events');
+    source.addEventListener('render', function (e) {{
+        var data = JSON.parse(e.data);
+        content.innerHTML = data.html;
+        setBounds(data.window);
+        typeset(content);
+    }});
+    // follow the editor: scroll to the block of the first visible line, or
+    // proportionally by lines (or window points) without block markers
+    source.addEventListener('scroll', function (e) {{
+        var position = JSON.parse(e.data);
+        var fraction;
+        var marker = position.block === undefined ? null :
+            content.querySelector('.markmon-block[data-block="' + position.block + '"]');
+        if (marker) {{
+            var next = content.querySelector('.markmon-block[data-block="' + (position.block + 1) + '"]');
+            var top = marker.getBoundingClientRect().top + window.pageYOffset;
+            var bottom = next ? next.getBoundingClientRect().top + window.pageYOffset : top;
+            window.scrollTo(0, top + position.fraction * (bottom - top));
+            return;
+        }}
+        if (bounds) {{
+            fraction = (position.point - bounds.begin) / Math.max(1, bounds.end - bounds.begin);
+        }} else {{
+            fraction = position.top / Math.max(1, position.lines - (position.bottom - position.top));
+        }}
+        fraction = Math.max(0, Math.min(1, fraction));
+        window.scrollTo(0, fraction * (document.documentElement.scrollHeight - window.innerHeight));
+    }});
+    source.addEventListener('outline', function (e) {{
+        setOutline(JSON.parse(e.data).outline);
+    }});
+    source.addEventListener('reload', function () {{
+        window.location.reload();
+    }});
+}})();
+</script>
+</body>
+</html>
+'''
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class PreviewServer:
+    """
+    Hold the current document, render it and publish the result.
+
+    Rendering runs on its own thread and always picks up the newest
+    document, so a burst of updates results in at most one pending render.
+    A render that is still running when a newer revision arrives is
+    cancelled, unless the preview has already been stale for
+    MAX_STALENESS seconds, counted from the first update it does not show,
+    so continuous typing cannot starve it.
+
+    A large document can be shown a window at a time (show_window()). The
+    browser then asks for the neighbouring windows as it is scrolled, which
+    source, when set, provides: source(buffer, point, direction) returns
+    (begin, end, text) of the window before, after or around point.
+
+    With socket_path the server also listens on that Unix domain socket,
+    for the plugin; browsers always use the TCP port, which may be 0 to
+    have one picked (see port).
+
+    Requests that change the server are refused when they come from a web
+    page, which browsers mark with an Origin header, and, with a token,
+    when they do not carry it in X-Markmon-Token.
+
+    reconfigure() swaps the renderer and stylesheet of a running server.
+    It is only called by the program embedding the server; no request
+    changes the converter command or stylesheet path.
+
+    Every finished render is also broadcast as a "status" event with the
+    revision, the seconds it took and the converter error, if any, which
+    the channels of the plugin pass on.
+
+    """
+
+    MAX_STALENESS = 2.0
+
+    def __init__(self, port, renderer, stylesheet=None, projectdir=None, host='localhost', socket_path=None,
+                 token=None):
+        self.address = (host, port)
+        self.socket_path = socket_path
+        self.token = token
+        self.renderer = renderer
+        self.retired = []
+        self.stylesheet = stylesheet
+        self.projectdir = projectdir
+        self.generation = 0
+
+        self.lock = threading.Condition()
+        self.text = ''
+        self.path = ''
+        self.buffer = None
+        self.revision = None
+        # (begin, end, size) of the window of a large document held as text
+        self.window = None
+        # editor line the window starts on
+        self.window_line = 0
+        self.outline = []
+        self.source = None
+        self.dirty = False
+        self.html = ''
+        self.html_window = None
+        self.clients = set()
+        # sockets of open channels, closed when the server stops
+        self.channels = set()
+
+        self.job = None
+        # when the first update the preview does not show yet arrived
+        self.stale_since = None
+        # when the first update the running render does not include arrived
+        self.newer_since = None
+        self.renders = 0
+        self.cancelled_renders = 0
+        self.wasted_render_time = 0.0
+        self.scrolls = 0
+
+        self.httpd = None
+        self.unix_httpd = None
+        self.running = False
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(self.address, PreviewRequestHandler)
+        self.httpd.preview = self
+        if self.socket_path:
+            try:
+                remove_stale_socket(self.socket_path)
+                self.unix_httpd = ThreadingUnixHTTPServer(self.socket_path, PreviewRequestHandler)
+            except OSError:
+                self.httpd.server_close()
+                raise
+            self.unix_httpd.preview = self
+        self.running = True
+        threading.Thread(target=self.httpd.serve_forever, name="markmon-http", daemon=True).start()
+        if self.unix_httpd:
+            threading.Thread(target=self.unix_httpd.serve_forever, name="markmon-unix", daemon=True).start()
+        threading.Thread(target=self.render_loop, name="markmon-render", daemon=True).start()
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.lock.notify_all()
+            if self.job:
+                self.job.cancel()
+            clients = list(self.clients)
+            channels = list(self.channels)
+        for client in clients:
+            client.put(None)
+        for channel in channels:
+            try:
+                channel.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.unix_httpd:
+            self.unix_httpd.shutdown()
+            self.unix_httpd.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+        for renderer in self.retired + [self.renderer]:
+            renderer.close()
+
+    def reconfigure(self, renderer, stylesheet):
+        """
+        Render with renderer and show stylesheet from now on.
+
+        The current document is rendered again and browsers reload the page.
+        The old renderer is closed by the render thread once it is idle.
+
+        """
+        with self.lock:
+            if renderer is not self.renderer:
+                self.retired.append(self.renderer)
+                self.renderer = renderer
+            self.stylesheet = stylesheet
+            self.generation += 1
+            if self.job:
+                self.job.cancel()
+            if self.revision is not None or self.text:
+                self.dirty = True
+                self.lock.notify_all()
+        self.broadcast('reload', {})
+
+    def update(self, text, path='', buffer=None, revision=None):
+        with self.lock:
+            self.text = text
+            self.path = path
+            self.buffer = buffer
+            self.revision = revision
+            self.window = None
+            self.window_line = 0
+            self.mark_dirty()
+        self.set_outline([])
+
+    def show_window(self, window):
+        """Hold and render a window of a large document (a PUT /window body)."""
+        with self.lock:
+            self.text = window["text"]
+            self.path = window.get("path", '')
+            self.buffer = window.get("buffer")
+            self.revision = window.get("revision")
+            self.window = (window["begin"], window["end"], window["size"])
+            self.window_line = window.get("line", 0)
+            self.mark_dirty()
+        # the outline is left out while it does not change
+        if "outline" in window:
+            self.set_outline(window["outline"])
+
+    def set_outline(self, outline):
+        with self.lock:
+            if outline == self.outline:
+                return
+            self.outline = outline
+        self.broadcast('outline', {"outline": outline})
+
+    def scroll(self, position):
+        """
+        Scroll the browsers to the editor position; this never renders.
+
+        With a block renderer the first visible line is looked up in the
+        block index, so browsers can scroll to the marker of that block.
+
+        """
+        with self.lock:
+            self.scrolls += 1
+            index = self.renderer.index
+            line = position.get("top", 0) - self.window_line
+        found = index.lookup(line) if index else None
+        if found:
+            position = dict(position, block=found[0], fraction=found[1])
+        self.broadcast('scroll', position)
+
+    def fetch(self, point, direction):
+        """Render the window before, after or around point; return None if there is no source."""
+        with self.lock:
+            source, buffer, window, renderer = self.source, self.buffer, self.window, self.renderer
+        if not source or not window:
+            return None
+        part = source(buffer, point, direction)
+        if not part:
+            return None
+        begin, end, text = part
+        try:
+            html = renderer.render(text)
+        except ConverterError as e:
+            html = '<pre class="markmon-error">{}</pre>'.format(escape(str(e)))
+        return {"begin": begin, "end": end, "size": window[2], "html": html}
+
+    def mark_dirty(self):
+        self.dirty = True
+        self.lock.notify_all()
+        now = time.monotonic()
+        if self.stale_since is None:
+            self.stale_since = now
+        if self.newer_since is None:
+            self.newer_since = now
+        if self.job and now - self.stale_since < self.MAX_STALENESS:
+            self.job.cancel()
+
+    def patch(self, delta):
+        """Apply a delta; return False if it does not apply to the current document."""
+        with self.lock:
+            if (self.revision is None or self.window or delta.get("buffer") != self.buffer or
+                    delta.get("base") != self.revision):
+                return False
+            text = self.text
+            for begin, end, replacement in delta["changes"]:
+                if not 0 <= begin <= end <= len(text):
+                    return False
+                text = text[:begin] + replacement + text[end:]
+            self.text = text
+            self.path = delta.get("path", self.path)
+            self.revision = delta["revision"]
+            self.mark_dirty()
+            return True
+
+    def render_loop(self):
+        while True:
+            with self.lock:
+                while self.running and not self.dirty:
+                    self.lock.wait()
+                if not self.running:
+                    return
+                text = self.text
+                window = self.window
+                self.dirty = False
+                self.newer_since = None
+                job = self.job = RenderJob(self.revision)
+                renderer = self.renderer
+                retired, self.retired = self.retired, []
+            for old in retired:
+                old.close()
+            error = None
+            try:
+                html = renderer.render(text, job, track=True)
+            except RenderCancelled:
+                with self.lock:
+                    self.cancelled_renders += 1
+                    self.wasted_render_time += time.monotonic() - job.started
+                continue
+            except ConverterError as e:
+                error = str(e)
+                html = '<pre class="markmon-error">{}</pre>'.format(escape(error))
+            except Exception:
+                traceback.print_exc()
+                continue
+            finally:
+                with self.lock:
+                    self.job = None
+            with self.lock:
+                self.html = html
+                self.html_window = window_bounds(window)
+                self.renders += 1
+                self.stale_since = self.newer_since
+            self.broadcast('render', {"html": html, "window": window_bounds(window)})
+            self.broadcast('status', {
+                "revision": job.revision,
+                "seconds": time.monotonic() - job.started,
+                "error": error
+            })
+
+    def stats(self):
+        with self.lock:
+            return {
+                "renders": self.renders,
+                "cancelled_renders": self.cancelled_renders,
+                "wasted_render_time": self.wasted_render_time,
+                "scrolls": self.scrolls
+            }
+
+    def subscribe(self):
+        client = queue.Queue()
+        with self.lock:
+            self.clients.add(client)
+            html, window, outline = self.html, self.html_window, self.outline
+        client.put(('render', {"html": html, "window": window}))
+        client.put(('outline', {"outline": outline}))
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def broadcast(self, event, data):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.put((event, data))
+
+    def page(self):
+        stylesheet = ''
+        if self.stylesheet:
+            stylesheet = '<link rel="stylesheet" href="{}?{}">'.format(STYLESHEET_URL, self.generation)
+        with self.lock:
+            html = self.html
+        return PAGE.format(stylesheet=stylesheet, content=html)
+
+    def resolve_file(self, url_path):
+        """Map a request path to a file in the project or document directory."""
+        if url_path == STYLESHEET_URL and self.stylesheet:
+            return os.path.expanduser(self.stylesheet)
+        with self.lock:
+            path = self.path
+        roots = [root for root in (self.projectdir, os.path.dirname(path)) if root]
+        relative = os.path.normpath(url_path.lstrip('/'))
+        if relative.startswith('..') or os.path.isabs(relative):
+            return None
+        for root in roots:
+            candidate = os.path.join(os.path.expanduser(root), relative)
+            if os.path.isfile(candidate):
+                return candidate
+        return None
+
+
+def remove_stale_socket(path):
+    """
+    Remove a socket file left behind by a server that is gone.
+
+    Raise OSError if path is anything but a socket nobody listens on, so
+    no other file is ever deleted.
+
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, "Not a socket, leaving it alone", path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        sock.close()
+    raise OSError(errno.EADDRINUSE, "Another server listens on the socket", path)
+
+
+def parse_document(body):
+    """Split a PUT / body into the document text and the path in its FILEPATH comment."""
+    text = body.decode('utf-8', 'replace')
+    match = FILEPATH_RE.match(text)
+    if match:
+        return text[match.end():], match.group('path')
+    return text, ''
+
+
+def window_bounds(window):
+    if window is None:
+        return None
+    begin, end, size = window
+    return {"begin": begin, "end": end, "size": size}
+
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+class PreviewRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def preview(self):
+        return self.server.preview
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                length = int(self.rfile.readline().split(b';')[0], 16)
+                chunks.append(self.rfile.read(length))
+                self.rfile.readline()
+                if not length:
+                    return b''.join(chunks)
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def allowed(self, json_body=False):
+        """Return whether a request may change the server; respond to it if not."""
+        token = self.preview.token
+        if self.headers.get('Origin') is not None or (
+                token and not hmac.compare_digest(self.headers.get('X-Markmon-Token', ''), token)):
+            self.read_body()
+            self.respond(403)
+            return False
+        # a page can only send other content types after a CORS preflight, which is never answered
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if json_body and content_type != 'application/json':
+            self.read_body()
+            self.respond(415)
+            return False
+        return True
+
+    def respond(self, status, body=b'', content_type='text/plain; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        window = self.path.split('?', 1)[0] == '/window'
+        if not self.allowed(json_body=window):
+            return
+        if window:
+            self.put_window()
+            return
+        text, path = parse_document(self.read_body())
+        buffer = self.headers.get('X-Markmon-Buffer')
+        revision = self.headers.get('X-Markmon-Revision')
+        self.preview.update(text, path,
+                            int(buffer) if buffer else None,
+                            int(revision) if revision else None)
+        self.respond(200)
+
+    def do_PATCH(self):
+        if not self.allowed(json_body=True):
+            return
+        try:
+            delta = json.loads(self.read_body().decode('utf-8'))
+        except ValueError:
+            self.respond(400)
+            return
+        self.respond(204 if self.preview.patch(delta) else 409)
+
+    def do_POST(self):
+        url_path = self.path.split('?', 1)[0]
+        if not self.allowed(json_body=url_path != '/channel'):
+            return
+        if url_path == '/cursor':
+            self.post_cursor()
+            return
+        if url_path == '/channel':
+            self.serve_channel()
+            return
+        self.read_body()
+        self.respond(404)
+
+    def post_cursor(self):
+        try:
+            position = json.loads(self.read_body().decode('utf-8'))
+        except ValueError:
+            self.respond(400)
+            return
+        self.preview.scroll(position)
+        self.respond(204)
+
+    def serve_channel(self):
+        """
+        Upgrade the connection to a channel and serve it until it is closed.
+
+        Messages are handled in the order they arrive. Updates are
+        acknowledged with the status their HTTP request would have got,
+        cursor messages are not acknowledged at all. "status" events are
+        pushed to the plugin from a thread of their own.
+
+        """
+        self.read_body()
+        if self.headers.get('Upgrade', '').lower() != UPGRADE:
+            self.respond(400)
+            return
+        self.send_response(101)
+        self.send_header('Upgrade', UPGRADE)
+        self.send_header('Connection', 'Upgrade')
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        lock = threading.Lock()
+
+        def write(message):
+            with lock:
+                write_frame(self.connection.sendall, message)
+
+        with self.preview.lock:
+            if not self.preview.running:
+                return
+            self.preview.channels.add(self.connection)
+        client = self.preview.subscribe()
+        threading.Thread(target=self.push_status, args=(client, write),
+                         name="markmon-channel", daemon=True).start()
+        try:
+            while True:
+                received = read_message(self.rfile)
+                if received is None:
+                    return
+                message, body = received
+                status = self.channel_message(message, body)
+                if status is not None:
+                    write({"type": "ack", "id": message.get("id"), "status": status})
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.preview.lock:
+                self.preview.channels.discard(self.connection)
+            self.preview.unsubscribe(client)
+            client.put(None)
+
+    def channel_message(self, message, body):
+        """Handle a channel message; return the status to acknowledge it with, or None."""
+        kind = message.get("type")
+        try:
+            if kind == "cursor":
+                self.preview.scroll(message["position"])
+                return None
+            if kind == "update":
+                text, path = parse_document(body)
+                self.preview.update(text, path, message.get("buffer"), message.get("revision"))
+                return 200
+            if kind == "patch":
+                return 204 if self.preview.patch(message) else 409
+            if kind == "window":
+                window = dict(message, text=body.decode('utf-8', 'replace'))
+                if not all(key in window for key in ("begin", "end", "size")):
+                    return 400
+                self.preview.show_window(window)
+                return 204
+        except (KeyError, TypeError, ValueError):
+            return 400
+        return 400
+
+    def push_status(self, client, write):
+        while True:
+            message = client.get()
+            if message is None:
+                return
+            event, data = message
+            if event not in CHANNEL_EVENTS:
+                continue
+            try:
+                write(dict(data, type=event))
+            except OSError:
+                return
+
+    def put_window(self):
+        try:
+            window = json.loads(self.read_body().decode('utf-8'))
+        except ValueError:
+            self.respond(400)
+            return
+        if not all(key in window for key in ("text", "begin", "end", "size")):
+            self.respond(400)
+            return
+        self.preview.show_window(window)
+        self.respond(204)
+
+    def do_DELETE(self):
+        if not self.allowed():
+            return
+        self.read_body()
+        self.respond(200)
+        threading.Thread(target=self.preview.stop, daemon=True).start()
+
+    def do_GET(self):
+        url_path = self.path.split('?', 1)[0]
+        if url_path == '/':
+            self.respond(200, self.preview.page().encode('utf-8'), 'text/html; charset=utf-8')
+        elif url_path == '/events':
+            self.stream_events()
+        elif url_path == '/window':
+            self.get_window()
+        elif url_path == '/stats':
+            self.respond(200, json.dumps(self.preview.stats()).encode('utf-8'), 'application/json')
+        else:
+            self.send_file(url_path)
+
+    def get_window(self):
+        query = parse_qs(self.path.split('?', 1)[1] if '?' in self.path else '')
+        try:
+            point = int(query['point'][0])
+        except (KeyError, ValueError):
+            self.respond(400)
+            return
+        direction = query.get('direction', ['around'])[0]
+        part = self.preview.fetch(point, direction)
+        if part is None:
+            self.respond(404)
+            return
+        self.respond(200, json.dumps(part).encode('utf-8'), 'application/json')
+
+    def send_file(self, url_path):
+        path = self.preview.resolve_file(unquote(url_path))
+        if not path:
+            self.respond(404)
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.respond(200, body, mimetypes.guess_type(path)[0] or 'application/octet-stream')
+
+    def stream_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        client = self.preview.subscribe()
+        try:
+            while True:
+                try:
+                    message = client.get(timeout=15)
+                except queue.Empty:
+                    self.wfile.write(b': ping\n\n')
+                    self.wfile.flush()
+                    continue
+                if message is None:
+                    return
+                event, data = message
+                if event in CHANNEL_EVENTS:
+                    continue
+                self.wfile.write('event: {}\ndata: {}\n\n'.format(event, json.dumps(data)).encode('utf-8'))
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            self.preview.unsubscribe(client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument('--socket', help='also listen on this Unix domain socket')
+    parser.add_argument('--command', default='pandoc -t HTML5')
+    parser.add_argument('--stylesheet')
+    parser.add_argument('--projectdir')
+    parser.add_argument('--blocks', action='store_true', help='render changed blocks only')
+    parser.add_argument('--cache-size', type=int, default=32, help='block cache size in MB')
+    parser.add_argument('--workers', type=int, default=0, help='parallel converter processes (0: one per CPU)')
+    parser.add_argument('--converter-mode', default='oneshot', choices=('oneshot', 'stream', 'pandoc-server'))
+    parser.add_argument('--max-jobs', type=int, default=500, help='documents per converter worker before it is recycled')
+    parser.add_argument('--token', default=os.environ.get('MARKMON_TOKEN'),
+                        help='only accept updates carrying this X-Markmon-Token (default: $MARKMON_TOKEN)')
+    args = parser.parse_args()
+
+    renderer = make_renderer(args.command, blocks=args.blocks, cache_bytes=args.cache_size << 20,
+                             workers=args.workers, mode=args.converter_mode, max_jobs=args.max_jobs)
+    server = PreviewServer(args.port, renderer, args.stylesheet, args.projectdir, socket_path=args.socket,
+                           token=args.token)
+    server.start()
+    try:
+        while server.running:
+            with server.lock:
+                server.lock.wait(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+# coding=utf8
+
+"""
+Long-lived converter processes for the builtin preview server.
+
+Starting a converter such as pandoc for every render costs 100-300ms, so
+documents can instead be sent to a pool of processes that stay alive:
+
+- "pandoc-server" runs `pandoc server` and posts documents to its HTTP API.
+- "stream" runs the configured command once and exchanges framed documents
+  over stdin/stdout. Each frame is the payload length in bytes in ASCII
+  decimal, a newline, then the UTF-8 payload; the reply uses the same framing.
+
+Like render.py, this module only depends on the standard library.
+
+"""
+
+import http.client
+import json
+import socket
+import threading
+import time
+
+
+class WorkerError(Exception):
+    """A worker failed in a way that a one-shot conversion might not."""
+
+
+class WorkerInterrupted(WorkerError):
+    """A worker was killed because the render it worked for was cancelled."""
+
+
+def drain(stream):
+    """Discard everything written to stream so the process never blocks on a full pipe."""
+    def run():
+        try:
+            while stream.read(8192):
+                pass
+        except (OSError, ValueError):
+            pass
+    threading.Thread(target=run, daemon=True).start()
+
+
+class ConverterWorker:
+    # whether a cancelled render may kill the worker process
+    cancellable = True
+    # seconds a worker may take to convert one document before it is killed
+    REPLY_TIMEOUT = 30
+
+    def __init__(self, popen, args):
+        self.process = popen(args)
+        if self.process is None:
+            raise WorkerError("Could not start converter worker: {}".format(" ".join(args)))
+        self.jobs = 0
+
+    def healthy(self):
+        return self.process.poll() is None
+
+    def convert(self, text):
+        raise NotImplementedError
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            try:
+                if stream:
+                    stream.close()
+            except OSError:
+                pass
+
+
+class StreamWorker(ConverterWorker):
+    """A converter command that converts framed documents read from stdin."""
+
+    def __init__(self, popen, args):
+        super().__init__(popen, args)
+        if self.process.stderr:
+            drain(self.process.stderr)
+        self.expired = False
+
+    def convert(self, text):
+        payload = text.encode('utf-8')
+        # a worker that stops replying is killed so the reads below return
+        timer = threading.Timer(self.REPLY_TIMEOUT, self.expire)
+        timer.daemon = True
+        timer.start()
+        try:
+            self.process.stdin.write(str(len(payload)).encode('ascii') + b'\n' + payload)
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            length = int(header)
+            out = self.process.stdout.read(length)
+        except (OSError, ValueError) as e:
+            raise self.failure("Converter worker failed: {}".format(e))
+        finally:
+            timer.cancel()
+        if len(out) != length:
+            raise self.failure("Converter worker exited mid-reply")
+        return out.decode('utf-8', 'replace')
+
+    def expire(self):
+        self.expired = True
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+    def failure(self, message):
+        if self.expired:
+            message = "Converter worker did not reply within {} seconds".format(self.REPLY_TIMEOUT)
+        return WorkerError(message)
+
+
+class PandocServerWorker(ConverterWorker):
+    """
+    A `pandoc server` process converting documents over HTTP.
+
+    Only the pandoc options that have an equivalent in the server API are
+    supported: the input and output formats, --mathjax and --standalone.
+
+    """
+
+    STARTUP_TIMEOUT = 10
+    IDLE_CHECK = 30
+    # restarting pandoc server costs more than finishing a stale render
+    cancellable = False
+
+    def __init__(self, popen, args):
+        self.options = self.parse_options(args[1:])
+        self.port = free_port()
+        super().__init__(popen, [args[0], 'server', '--port', str(self.port)])
+        for stream in (self.process.stdout, self.process.stderr):
+            if stream:
+                drain(stream)
+        self.connection = http.client.HTTPConnection('localhost', self.port, timeout=self.REPLY_TIMEOUT)
+        self.last_used = time.monotonic()
+        self.wait_until_ready()
+
+    @staticmethod
+    def parse_options(args):
+        options = {"from": "markdown", "to": "html5"}
+        names = {'-f': 'from', '-r': 'from', '--from': 'from', '--read': 'from',
+                 '-t': 'to', '-w': 'to', '--to': 'to', '--write': 'to'}
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            name, _, value = arg.partition('=')
+            if name in names:
+                options[names[name]] = (value or args.pop(0)).lower()
+            elif arg == '--mathjax':
+                options["html-math-method"] = {"method": "mathjax"}
+            elif arg in ('-s', '--standalone'):
+                options["standalone"] = True
+            else:
+                raise WorkerError("Option {} is not supported by pandoc server".format(arg))
+        return options
+
+    def wait_until_ready(self):
+        deadline = time.monotonic() + self.STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                socket.create_connection(('localhost', self.port), timeout=0.1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.close()
+        raise WorkerError("pandoc server did not start")
+
+    def healthy(self):
+        if not super().healthy():
+            return False
+        if time.monotonic() - self.last_used < self.IDLE_CHECK:
+            return True
+        try:
+            status, _ = self.request('GET', '/version')
+        except WorkerError:
+            return False
+        return status == 200
+
+    def request(self, method, path, body=None, headers={}):
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            self.connection.close()
+            raise WorkerError("pandoc server request failed: {}".format(e))
+        self.last_used = time.monotonic()
+        return response.status, data
+
+    def convert(self, text):
+        options = dict(self.options, text=text)
+        status, data = self.request('POST', '/', json.dumps(options).encode('utf-8'),
+                                    {"Content-Type": "application/json", "Accept": "application/json"})
+        if status != 200:
+            raise WorkerError(data.decode('utf-8', 'replace'))
+        return json.loads(data.decode('utf-8'))["output"]
+
+    def close(self):
+        self.connection.close()
+        super().close()
+
+
+WORKERS = {
+    "stream": StreamWorker,
+    "pandoc-server": PandocServerWorker
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class WorkerPool:
+    """
+    A bounded pool of converter workers.
+
+    Workers are started on demand, checked before each use and replaced
+    once they have converted max_jobs documents, become unhealthy or take
+    longer than REPLY_TIMEOUT seconds to convert a document.
+
+    """
+
+    def __init__(self, popen, args, mode, size=1, max_jobs=500):
+        self.factory = lambda: WORKERS[mode](popen, args)
+        self.slots = threading.Semaphore(size)
+        self.max_jobs = max_jobs
+        self.idle = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def convert(self, text, job=None):
+        with self.slots:
+            worker = self.acquire()
+            if job and worker.cancellable:
+                job.register(worker.process)
+            try:
+                out = worker.convert(text)
+            except WorkerError as e:
+                worker.close()
+                if job and job.killed(worker.process):
+                    raise WorkerInterrupted(str(e))
+                raise
+            except Exception:
+                worker.close()
+                raise
+            finally:
+                if job:
+                    job.unregister(worker.process)
+            worker.jobs += 1
+            self.release(worker)
+            return out
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if self.closed:
+                    raise WorkerError("Converter pool is closed")
+                worker = self.idle.pop() if self.idle else None
+            if worker is None:
+                return self.factory()
+            if worker.healthy():
+                return worker
+            worker.close()
+
+    def release(self, worker):
+        with self.lock:
+            if not self.closed and worker.jobs < self.max_jobs:
+                self.idle.append(worker)
+                return
+        worker.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for worker in idle:
+            worker.close()
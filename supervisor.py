@@ -0,0 +1,227 @@
+# coding=utf8
+
+"""Keep the markmon server process running."""
+
+import errno
+import os
+import socket
+import threading
+import time
+
+
+def connect(address, timeout):
+    """Connect to a local port, or to a Unix domain socket when address is a path."""
+    if isinstance(address, int):
+        return socket.create_connection(("localhost", address), timeout=timeout)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def accepts(address, timeout):
+    """Return whether something accepts connections on the address."""
+    try:
+        connect(address, timeout).close()
+        return True
+    except OSError:
+        return False
+
+
+def process_exists(pid):
+    """Return whether a process with this id runs; on Windows, where this cannot be asked safely, assume so."""
+    if not isinstance(pid, int) or pid <= 0:
+        return False
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # it exists but belongs to someone else
+        pass
+    return True
+
+
+def responds(address, timeout, path='/'):
+    """Return whether an HTTP server on the address answers a request for path."""
+    import http.client
+    connection = http.client.HTTPConnection("localhost", timeout=timeout)
+    try:
+        connection.sock = connect(address, timeout)
+        connection.request('GET', path)
+        connection.getresponse().read()
+        return True
+    except (http.client.HTTPException, OSError):
+        return False
+    finally:
+        connection.close()
+
+
+class MarkmonSupervisor:
+    """
+    Own the server of a MarkmonServer and restart it when it goes down.
+
+    The server does the actual work through launch(), alive(), reap() and
+    evict(); the supervisor decides when. All starts and stops go through
+    one lock, so concurrent callbacks never spawn a second server. Before
+    launching, a server an earlier run of the plugin left on the port or
+    socket is asked to shut down; if anything else listens there, the
+    server is no longer wanted and launching fails.
+
+    While the server is wanted a health check probes it every
+    HEALTH_INTERVAL seconds: the builtin server is asked for its /stats, and
+    the markmon server, which has no page cheaper than the preview, only
+    has to accept a connection. A server that exited, or that stopped
+    answering once its startup_timeout has passed, is restarted. Restarts
+    back off exponentially from MIN_BACKOFF to MAX_BACKOFF seconds; the
+    backoff is forgotten once a server stayed up for STABLE_TIME seconds.
+
+    """
+
+    HEALTH_INTERVAL = 5.0
+    HEALTH_TIMEOUT = 2.0
+    UNHEALTHY_LIMIT = 2
+    MIN_BACKOFF = 0.5
+    MAX_BACKOFF = 60.0
+    STABLE_TIME = 30.0
+
+    def __init__(self, settings, server):
+        self.settings = settings
+        self.server = server
+        self.lock = threading.RLock()
+        self.wanted = False
+        self.started_at = None
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.restarts = 0
+        self.unhealthy = 0
+        self.health_thread = None
+        self.closed = threading.Event()
+
+    @property
+    def address(self):
+        """The port or Unix domain socket path the plugin talks to the server on."""
+        return self.settings.socket_path or self.settings.settings["port"]
+
+    def start(self):
+        """Replace the current server with a new one, if the plugin is running."""
+        with self.lock:
+            self.server.reap()
+            self.wanted = self.settings.running
+            if not self.wanted:
+                return
+            self.failures = 0
+            self.next_attempt = 0.0
+            self.launch()
+            if not self.health_thread:
+                self.health_thread = threading.Thread(target=self.health_loop,
+                                                      name="markmon-supervisor", daemon=True)
+                self.health_thread.start()
+
+    def stop(self):
+        """Stop the server and reap its process."""
+        with self.lock:
+            self.wanted = False
+            self.server.reap()
+
+    def close(self):
+        self.stop()
+        self.closed.set()
+
+    def launch(self):
+        if accepts(self.address, 0.25) and not self.server.evict(self.address):
+            self.wanted = False
+            raise OSError(errno.EADDRINUSE, "Address taken by another server", str(self.address))
+        self.started_at = time.monotonic()
+        self.unhealthy = 0
+        self.server.launch()
+
+    def starting(self):
+        return (self.started_at is not None and
+                time.monotonic() - self.started_at < self.settings.settings["startup_timeout"])
+
+    def ensure_running(self):
+        """
+        Make sure the server is up, restarting it if it is not.
+
+        Return whether the server accepts connections. Return False right
+        away while a restart is backing off.
+
+        """
+        with self.lock:
+            if not self.wanted:
+                return False
+            if not self.server.alive() or not (self.starting() or accepts(self.address, 0.25)):
+                if not self.restart():
+                    return False
+        return self.wait_until_ready()
+
+    def restart(self):
+        now = time.monotonic()
+        if now < self.next_attempt:
+            return False
+        if self.started_at is not None and now - self.started_at > self.STABLE_TIME:
+            self.failures = 0
+        self.next_attempt = now + min(self.MIN_BACKOFF * (2 ** self.failures), self.MAX_BACKOFF)
+        self.failures += 1
+        self.restarts += 1
+        print("Markmon server on {} is down, restarting it.".format(self.address))
+        self.server.reap()
+        try:
+            self.launch()
+        except OSError:
+            return False
+        return True
+
+    def wait_until_ready(self):
+        """
+        Poll the server port or socket until it accepts connections.
+
+        Probes back off from 25ms to 250ms. Return False if the server exits
+        or "startup_timeout" seconds pass before the port is open.
+
+        """
+        deadline = time.monotonic() + self.settings.settings["startup_timeout"]
+        delay = 0.025
+        while True:
+            if accepts(self.address, delay):
+                return True
+            if not self.server.alive():
+                return False
+            if time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+    def probe(self):
+        if self.settings.settings["backend"] == "builtin":
+            return responds(self.address, self.HEALTH_TIMEOUT, '/stats')
+        return accepts(self.address, self.HEALTH_TIMEOUT)
+
+    def health_loop(self):
+        while not self.closed.wait(self.HEALTH_INTERVAL):
+            if not self.wanted or (self.starting() and self.server.alive()):
+                continue
+            healthy = self.server.alive() and self.probe()
+            with self.lock:
+                # the server may have been replaced while it was probed
+                if not self.wanted or (self.starting() and self.server.alive()):
+                    continue
+                if healthy:
+                    self.unhealthy = 0
+                    continue
+                self.unhealthy += 1
+                if self.server.alive() and self.unhealthy < self.UNHEALTHY_LIMIT:
+                    continue
+                if not self.restart():
+                    continue
+            self.wait_until_ready()
+
+    def stats(self):
+        return {"server_restarts": self.restarts}
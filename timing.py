@@ -0,0 +1,121 @@
+# coding=utf8
+
+"""Per-update timing of the preview pipeline."""
+
+from collections import deque
+import threading
+import time
+
+PHASES = ('read', 'encode', 'connect', 'send', 'response', 'render', 'total')
+
+
+class MarkmonTimer:
+    """Accumulate the time spent in each phase of one update."""
+
+    def __init__(self):
+        self.started = self.last = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        """Charge the time since the previous mark to phase."""
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def finish(self):
+        self.phases['total'] = time.perf_counter() - self.started
+        return self.phases
+
+
+class NullTimer:
+    """Stands in for MarkmonTimer when timing is disabled."""
+
+    def mark(self, phase):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))]
+
+
+class MarkmonTimings:
+    """
+    Rolling per-view timings of preview updates.
+
+    The last SAMPLES durations of each phase are kept for every view. When
+    the "timing" setting is off, timer() hands out NULL_TIMER and record()
+    returns right away, so the instrumented code only pays for a no-op call.
+
+    """
+
+    SAMPLES = 256
+    STATUS_KEY = 'markmon'
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.views = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.settings.settings.get("timing", False)
+
+    def timer(self):
+        return MarkmonTimer() if self.enabled else NULL_TIMER
+
+    def record(self, view, timer):
+        if timer is NULL_TIMER:
+            return
+        phases = timer.finish()
+        with self.lock:
+            samples = self.views.setdefault(view.id(), {})
+            for phase, duration in phases.items():
+                samples.setdefault(phase, deque(maxlen=self.SAMPLES)).append(duration)
+        view.set_status(self.STATUS_KEY, 'markmon {:.0f}ms'.format(phases['total'] * 1000))
+
+    def add(self, view_id, phase, duration):
+        """Record a duration measured elsewhere, such as a render reported by the server."""
+        if not self.enabled:
+            return
+        with self.lock:
+            samples = self.views.setdefault(view_id, {})
+            samples.setdefault(phase, deque(maxlen=self.SAMPLES)).append(duration)
+
+    def discard(self, view_id):
+        with self.lock:
+            self.views.pop(view_id, None)
+
+    def summary(self):
+        """Return {view id: {phase: (count, p50, p90, p99, max)}} with durations in ms."""
+        with self.lock:
+            views = dict((view_id, dict((phase, list(samples)) for phase, samples in phases.items()))
+                         for view_id, phases in self.views.items())
+        summary = {}
+        for view_id, phases in views.items():
+            summary[view_id] = dict(
+                (phase, (len(samples),
+                         percentile(samples, 0.5) * 1000,
+                         percentile(samples, 0.9) * 1000,
+                         percentile(samples, 0.99) * 1000,
+                         max(samples) * 1000))
+                for phase, samples in phases.items() if samples)
+        return summary
+
+    def report(self, names={}):
+        """Return the timings of every view as text; names maps view ids to labels."""
+        lines = []
+        for view_id, phases in sorted(self.summary().items()):
+            lines.append('{} (view {})'.format(names.get(view_id, 'untitled'), view_id))
+            lines.append('  {:<10} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+                'phase', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+            for phase in PHASES:
+                if phase in phases:
+                    lines.append('  {:<10} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                        phase, *phases[phase]))
+        if not lines:
+            lines.append('No timings recorded. Set "timing": true in the Markmon settings.')
+        return '\n'.join(lines)
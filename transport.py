@@ -0,0 +1,294 @@
+# coding=utf8
+
+"""Connections from the plugin to the markmon server."""
+
+from collections import OrderedDict
+import socket
+import threading
+import traceback
+
+from .timing import NULL_TIMER
+
+# client urls of servers listening on a Unix domain socket start with this
+UNIX_PREFIX = "unix:"
+
+
+def open_socket(url):
+    """Connect a socket to the server at a client url."""
+    if not url.startswith(UNIX_PREFIX):
+        host, _, port = url.rpartition(':')
+        sock = socket.create_connection((host, int(port)))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(url[len(UNIX_PREFIX):])
+    except FileNotFoundError:
+        sock.close()
+        # no socket file means no server, as a refused port does
+        raise ConnectionRefusedError("No server at {}".format(url))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class ChannelUnsupported(Exception):
+    pass
+
+
+class MarkmonConnectionPool:
+    """
+    Keep-alive HTTP connections to the markmon server, keyed by client url.
+
+    A client url is either host:port or UNIX_PREFIX followed by the path of
+    a Unix domain socket.
+
+    Idle connections are reused for subsequent requests. A connection that
+    fails (for instance because the server closed an idle keep-alive socket)
+    is discarded and the request is retried once on a fresh connection.
+    ConnectionRefusedError is never retried so callers can react to the
+    server being down.
+
+    Every request carries token, when given, in an X-Markmon-Token header.
+
+    """
+
+    MAX_IDLE = 2
+
+    def __init__(self, token=None):
+        self.token = token
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def request(self, url, method, path, body=None, headers={}, timer=NULL_TIMER):
+        """
+        Send a request and return a (status, body) tuple.
+
+        body is bytes, an iterable of bytes (headers must then carry the
+        Content-Length) or a function returning an iterable of bytes. The
+        latter is sent with chunked transfer encoding, so the whole body is
+        never held in memory, and is called again when the request is retried.
+
+        """
+        import http.client
+        if self.token:
+            headers = dict(headers)
+            headers["X-Markmon-Token"] = self.token
+        for attempt in range(2):
+            connection, reused = self.acquire(url)
+            try:
+                if connection.sock is None:
+                    self.connect(connection, url)
+                timer.mark('connect')
+                if callable(body):
+                    self.send_chunked(connection, method, path, body(), headers)
+                else:
+                    connection.request(method, path, body, headers)
+                timer.mark('send')
+                response = connection.getresponse()
+                data = response.read()
+                timer.mark('response')
+            except ConnectionRefusedError:
+                connection.close()
+                raise
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if attempt or not reused:
+                    raise
+                continue
+
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(url, connection)
+            return response.status, data
+
+    @staticmethod
+    def connect(connection, url):
+        if not url.startswith(UNIX_PREFIX):
+            connection.connect()
+            return
+        connection.sock = open_socket(url)
+
+    @staticmethod
+    def send_chunked(connection, method, path, chunks, headers):
+        connection.putrequest(method, path)
+        for name, value in headers.items():
+            connection.putheader(name, value)
+        connection.putheader('Transfer-Encoding', 'chunked')
+        connection.endheaders()
+        for chunk in chunks:
+            if chunk:
+                connection.send(('%x\r\n' % len(chunk)).encode('ascii'))
+                connection.send(chunk)
+                connection.send(b'\r\n')
+        connection.send(b'0\r\n\r\n')
+
+    def acquire(self, url):
+        import http.client
+        with self.lock:
+            connections = self.idle.get(url)
+            if connections:
+                return connections.pop(), True
+        if url.startswith(UNIX_PREFIX):
+            return http.client.HTTPConnection("localhost"), False
+        return http.client.HTTPConnection(url), False
+
+    def release(self, url, connection):
+        with self.lock:
+            connections = self.idle.setdefault(url, [])
+            if len(connections) < self.MAX_IDLE:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Close every idle connection."""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class MarkmonChannel:
+    """
+    A persistent channel to the builtin server (see preview/channel.py).
+
+    send() writes a message and returns without waiting for the server, so
+    updates and cursor positions are pipelined. Whatever the server sends
+    back, acknowledgements and pushed "status" messages, is read on a
+    thread of its own and passed to receive(message); receive gets
+    {"type": "closed"} when the channel is lost, but not after close().
+
+    A message whose body is an iterable of bytes goes out as one frame per
+    chunk. A failed write closes the channel and raises
+    ConnectionRefusedError, so callers treat it like a server that is down.
+
+    """
+
+    HANDSHAKE_TIMEOUT = 2.0
+
+    def __init__(self, url, sock, stream, receive):
+        self.url = url
+        self.sock = sock
+        self.stream = stream
+        self.receive = receive
+        self.lock = threading.Lock()
+        self.closed = False
+        threading.Thread(target=self.read_loop, name="markmon-channel", daemon=True).start()
+
+    @classmethod
+    def open(cls, url, receive, token=None):
+        """Open a channel; raise ChannelUnsupported if the server does not offer one."""
+        from .preview.channel import UPGRADE
+        sock = open_socket(url)
+        try:
+            sock.settimeout(cls.HANDSHAKE_TIMEOUT)
+            sock.sendall(('POST /channel HTTP/1.1\r\nHost: localhost\r\nUpgrade: {}\r\n'
+                          'Connection: Upgrade\r\n{}Content-Length: 0\r\n\r\n').format(
+                              UPGRADE, 'X-Markmon-Token: {}\r\n'.format(token) if token else '').encode('ascii'))
+            stream = sock.makefile('rb')
+            status = stream.readline().split()
+            while stream.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            if len(status) < 2 or status[1] != b'101':
+                stream.close()
+                raise ChannelUnsupported("The server at {} has no channel.".format(url))
+            sock.settimeout(None)
+        except socket.timeout:
+            sock.close()
+            raise ChannelUnsupported("The server at {} did not answer the upgrade.".format(url))
+        except BaseException:
+            sock.close()
+            raise
+        return cls(url, sock, stream, receive)
+
+    def send(self, message, body=b''):
+        from .preview.channel import write_message
+        with self.lock:
+            if self.closed:
+                raise ConnectionRefusedError("The channel to {} is closed.".format(self.url))
+            try:
+                write_message(self.sock.sendall, message, body)
+            except OSError as e:
+                self.close()
+                raise ConnectionRefusedError("The channel to {} failed: {}".format(self.url, e))
+
+    def read_loop(self):
+        from .preview.channel import read_message
+        try:
+            while True:
+                received = read_message(self.stream)
+                if received is None:
+                    break
+                self.receive(received[0])
+        except (OSError, ValueError):
+            pass
+        self.stream.close()
+        if not self.closed:
+            self.close()
+            self.receive({"type": "closed"})
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class MarkmonSender:
+    """
+    Run network jobs on a dedicated worker thread.
+
+    Jobs are queued by key and only the latest job for a key is kept, so a
+    slow or unreachable server never builds up a backlog of stale updates.
+    The queue holds at most MAX_PENDING keys; when it is full the oldest
+    pending job is dropped. Submitting never blocks the caller.
+
+    """
+
+    MAX_PENDING = 16
+
+    def __init__(self, name="markmon-sender"):
+        self.name = name
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = True
+        self.dropped = 0
+
+    def submit(self, key, job):
+        with self.condition:
+            if not self.running:
+                return
+            if key not in self.pending and len(self.pending) >= self.MAX_PENDING:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.pending[key] = job
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                _, job = self.pending.popitem(last=False)
+            try:
+                job()
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.pending.clear()
+            self.condition.notify_all()
@@ -10,21 +10,23 @@
 #
 # Extracted from SublimeLinter3, for env stuff
 
-"""This module provides general utility methods."""
+"""
+This module provides general utility methods.
+
+Rarely used standard library modules are imported in the functions that
+need them to keep plugin load time down.
+
+"""
 
 from functools import lru_cache
-from glob import glob
 import json
 from numbers import Number
 import os
 import re
-import shutil
-from string import Template
 import sublime
 import subprocess
 import sys
-import tempfile
-from xml.etree import ElementTree
+import threading
 
 #
 # Public constants
@@ -51,6 +53,13 @@ MARK_COLOR_RE = (
 
 ANSI_COLOR_RE = re.compile(r'\033\[[0-9;]*m')
 
+ENV_CACHE_VERSION = 2
+SHELL_RC_FILES = (
+    '.profile', '.bash_profile', '.bash_login', '.bashrc',
+    '.zshenv', '.zprofile', '.zshrc', '.zlogin',
+    '.config/fish/config.fish'
+)
+
 # file/directory/environment utils
 
 def climb(start_dir, limit=None):
@@ -146,6 +155,12 @@ def get_shell_path(env):
 
     """
 
+    return query_shell_path(env) or guess_shell_path(env)
+
+
+def query_shell_path(env):
+    """Return the PATH of the user's login shell, or None if the shell could not tell."""
+
     if 'SHELL' in env:
         shell_path = env['SHELL']
         shell = os.path.basename(shell_path)
@@ -155,15 +170,19 @@ def get_shell_path(env):
         if shell in ('bash', 'zsh'):
             return extract_path(
                 (shell_path, '-l', '-c', 'echo "__SUBL_PATH__${PATH}__SUBL_PATH__"')
-            )
+            ) or None
         elif shell == 'fish':
             return extract_path(
                 (shell_path, '-l', '-c', 'echo "__SUBL_PATH__"; for p in $PATH; echo $p; end; echo "__SUBL_PATH__"'),
                 '\n'
-            )
-        else:
-            pass
-    # guess PATH if we haven't returned yet
+            ) or None
+
+    return None
+
+
+def guess_shell_path(env):
+    """Return PATH with the usual binary directories added."""
+
     split = env['PATH'].split(':')
     p = env['PATH']
 
@@ -179,26 +198,170 @@ def get_shell_path(env):
 
 @lru_cache(maxsize=None)
 def get_environment_variable(name):
-    """Return the value of the given environment variable, or None if not found."""
+    """
+    Return the value of the given environment variable, or None if not found.
+
+    On Posix systems the value comes from the login shell and is persisted
+    in the environment cache (see cached_environment).
+
+    """
 
     if os.name == 'posix':
-        value = None
+        return cached_environment('variables', name, lambda: query_environment_variable(name)) or None
+    else:
+        return os.environ.get(name, None)
 
-        if 'SHELL' in os.environ:
-            shell_path = os.environ['SHELL']
 
-            # We have to delimit the output with markers because
-            # text might be output during shell startup.
-            out = run_shell_cmd((shell_path, '-l', '-c', 'echo "__SUBL_VAR__${{{}}}__SUBL_VAR__"'.format(name))).strip()
+def query_environment_variable(name):
+    """
+    Return the value of the given environment variable in the user's login shell.
 
-            if out:
-                value = out.decode().split('__SUBL_VAR__', 2)[1].strip() or None
-    else:
-        value = os.environ.get(name, None)
+    Return '' if the variable is not set and None if the shell could not tell.
+
+    """
+
+    value = None
+
+    if 'SHELL' in os.environ:
+        shell_path = os.environ['SHELL']
+
+        # We have to delimit the output with markers because
+        # text might be output during shell startup.
+        out = run_shell_cmd((shell_path, '-l', '-c', 'echo "__SUBL_VAR__${{{}}}__SUBL_VAR__"'.format(name))).strip()
+        parts = out.decode().split('__SUBL_VAR__', 2)
+
+        if len(parts) > 2:
+            value = parts[1].strip()
 
     return value
 
 
+# environment cache
+
+env_cache_lock = threading.Lock()
+env_cache_refreshing = set()
+
+
+def env_cache_path():
+    """Return the path of the file persisting shell environment lookups."""
+    return os.path.join(sublime.cache_path(), 'Markmon', 'environment.json')
+
+
+def env_cache_key():
+    """
+    Return the key that the environment cache is valid for.
+
+    The key changes when the shell, the modification time of any of the
+    shell startup files or the "pandoc_path" setting changes.
+
+    """
+
+    home = os.path.expanduser('~')
+    mtimes = {}
+
+    for name in SHELL_RC_FILES:
+        try:
+            mtimes[name] = os.path.getmtime(os.path.join(home, name))
+        except OSError:
+            pass
+
+    return {
+        'version': ENV_CACHE_VERSION,
+        'shell': os.environ.get('SHELL', ''),
+        'rc_mtimes': mtimes,
+        'pandoc_path': sublime.load_settings(
+            'sublime-text-markmon.sublime-settings').get("pandoc_path", None)
+    }
+
+
+def read_env_cache():
+    try:
+        with open(env_cache_path(), encoding='utf8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    return cache if isinstance(cache, dict) else {}
+
+
+def write_env_cache(section, name, value, key):
+    """Store a value in the environment cache together with the key it was computed for."""
+
+    path = env_cache_path()
+
+    with env_cache_lock:
+        cache = read_env_cache()
+        values = cache.get(section)
+
+        if not isinstance(values, dict):
+            values = cache[section] = {}
+
+        values[name] = [key, value]
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + '.tmp'
+
+            with open(tmp, 'w', encoding='utf8') as f:
+                json.dump(cache, f)
+
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+
+def cached_environment(section, name, compute):
+    """
+    Return a shell environment value from the disk cache, computing it if needed.
+
+    Every value is cached with the key it was computed for. A value cached
+    under the current key is returned immediately. A value cached under an
+    outdated key is also returned immediately, but it is recomputed on a
+    background thread; once that finishes, the in-memory caches are cleared
+    so later calls see the new value. Only values that were never cached
+    are computed synchronously.
+
+    compute returns None when the shell could not be asked (it timed out,
+    for instance); that is returned but never cached, so the next lookup
+    asks again instead of reusing the failure.
+
+    """
+
+    key = env_cache_key()
+    values = read_env_cache().get(section)
+    entry = values.get(name) if isinstance(values, dict) else None
+
+    if not (isinstance(entry, list) and len(entry) == 2):
+        value = compute()
+
+        if value is not None:
+            write_env_cache(section, name, value, key)
+
+        return value
+
+    if entry[0] != key:
+        with env_cache_lock:
+            start = (section, name) not in env_cache_refreshing
+            env_cache_refreshing.add((section, name))
+
+        if start:
+            def refresh():
+                try:
+                    value = compute()
+
+                    # a failed refresh keeps the old value
+                    if value is not None:
+                        write_env_cache(section, name, value, key)
+                        clear_memory_caches()
+                finally:
+                    with env_cache_lock:
+                        env_cache_refreshing.discard((section, name))
+
+            threading.Thread(target=refresh, daemon=True).start()
+
+    return entry[1]
+
+
 def get_path_components(path):
     """Split a file path into its components and return the list of components."""
     components = []
@@ -257,7 +420,8 @@ def create_environment():
     env.update(os.environ)
 
     if os.name == 'posix':
-        env['PATH'] = get_shell_path(os.environ)
+        env['PATH'] = (cached_environment('path', 'PATH', lambda: query_shell_path(os.environ)) or
+                       guess_shell_path(os.environ))
 
     paths = {}
 
@@ -476,6 +640,8 @@ def find_windows_python(version):
         stripped_version = version.replace('.', '')
         prefix = os.path.abspath('\\Python')
         prefix_len = len(prefix)
+
+        from glob import glob
         dirs = glob(prefix + '*')
 
         # Try the exact version first, then the major version
@@ -540,20 +706,84 @@ def find_executable(executable):
 
     """
 
+    return resolve_executable(executable)
+
+
+executable_index = {}
+executable_index_lock = threading.Lock()
+
+
+def directory_entries(directory):
+    """
+    Return the set of entry names in directory.
+
+    The listing is indexed and only read again when the modification
+    time of the directory changes. On Windows names are lowercased.
+
+    """
+
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        return frozenset()
+
+    with executable_index_lock:
+        entry = executable_index.get(directory)
+
+    if entry and entry[0] == mtime:
+        return entry[1]
+
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        names = []
+
+    if os.name == 'nt':
+        names = [name.lower() for name in names]
+
+    names = frozenset(names)
+
+    with executable_index_lock:
+        executable_index[directory] = (mtime, names)
+
+    return names
+
+
+def resolve_executable(executable):
+    """
+    Return the absolute path to the given executable, or None if not found.
+
+    Unlike find_executable the result is not cached; instead PATH
+    directories are looked up in an index that is refreshed when a
+    directory changes, so each lookup costs one stat per PATH entry.
+
+    """
+
+    executable = os.path.expanduser(executable)
+
+    if os.path.dirname(executable):
+        return os.path.abspath(executable) if can_exec(executable) else None
+
+    extensions = ('',)
+
+    # On Windows, if path does not have an extension, try .exe, .cmd, .bat
+    if sublime.platform() == 'windows' and not os.path.splitext(executable)[1]:
+        extensions = ('.exe', '.cmd', '.bat')
+
     env = create_environment()
 
     for base in env.get('PATH', '').split(os.pathsep):
-        path = os.path.join(os.path.expanduser(base), executable)
+        base = os.path.abspath(os.path.expanduser(base))
+        names = directory_entries(base)
+
+        for extension in extensions:
+            name = executable + extension
 
-        # On Windows, if path does not have an extension, try .exe, .cmd, .bat
-        if sublime.platform() == 'windows' and not os.path.splitext(path)[1]:
-            for extension in ('.exe', '.cmd', '.bat'):
-                path_ext = path + extension
+            if (name.lower() if os.name == 'nt' else name) in names:
+                path = os.path.join(base, name)
 
-                if can_exec(path_ext):
-                    return path_ext
-        elif can_exec(path):
-            return path
+                if can_exec(path):
+                    return path
 
     return None
 
@@ -628,6 +858,7 @@ def tmpfile(cmd, code, suffix='', output_stream=STREAM_STDOUT, env=None):
 
     """
 
+    import tempfile
     f = None
 
     try:
@@ -669,6 +900,9 @@ def tmpdir(cmd, files, filename, code, output_stream=STREAM_STDOUT, env=None):
 
     """
 
+    import shutil
+    import tempfile
+
     filename = os.path.basename(filename)
     d = tempfile.mkdtemp()
     out = None
@@ -760,13 +994,28 @@ def apply_to_all_views(callback):
 # misc utils
 
 def clear_caches():
+    """Clear the caches of all methods in this module, including the environment cache on disk."""
+    clear_memory_caches()
+
+    with env_cache_lock:
+        try:
+            os.remove(env_cache_path())
+        except OSError:
+            pass
+
+
+def clear_memory_caches():
     """Clear the caches of all methods in this module that use an lru_cache."""
     create_environment.cache_clear()
+    get_environment_variable.cache_clear()
     which.cache_clear()
     find_python.cache_clear()
     get_python_paths.cache_clear()
     find_executable.cache_clear()
 
+    with executable_index_lock:
+        executable_index.clear()
+
 
 def convert_type(value, type_value, sep=None, default=None):
     """